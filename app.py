@@ -1,28 +1,128 @@
 # app.py
 import time
-from flask import Flask, render_template, request, jsonify, g
+from flask import Flask, render_template, request, jsonify, g, Response, stream_with_context, has_request_context
+from flask.logging import default_handler
 import sqlite3
 from datetime import datetime
 import os
+import pathlib
+import json
+import base64
+import re
+import random
 import logging
+import hmac
+import hashlib
+import threading
+import queue
+import signal
+import socket
+from collections import OrderedDict, deque
+from concurrent.futures import Future, TimeoutError as FutureTimeout
 from werkzeug.security import check_password_hash, generate_password_hash
+from werkzeug.serving import make_server
+from werkzeug.wsgi import ClosingIterator
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
 
 from functools import lru_cache
+import click
 
 app = Flask(__name__)
-logging.basicConfig(level=logging.DEBUG)
+# Signs access tokens; set DYNOTES_SECRET_KEY so tokens survive restarts
+app.secret_key = os.environ.get("DYNOTES_SECRET_KEY") or os.urandom(32)
+# DEBUG logs full search queries; keep it off in production. Root logging is
+# only configured by create_app, so importing this module leaves it alone
+LOG_LEVEL = os.environ.get("DYNOTES_LOG_LEVEL", "INFO").upper()
+app.logger.setLevel(LOG_LEVEL)
+
+DATABASE = os.environ.get("DYNOTES_DATABASE", "notes.db")
+
+# Connection tuning, overridable from the environment
+SQLITE_POOL_SIZE = int(os.environ.get("DYNOTES_SQLITE_POOL_SIZE", 8))
+SQLITE_CACHE_SIZE_KB = int(os.environ.get("DYNOTES_SQLITE_CACHE_KB", 64 * 1024))
+SQLITE_MMAP_SIZE = int(os.environ.get("DYNOTES_SQLITE_MMAP_SIZE", 256 * 1024 * 1024))
+SQLITE_STATEMENT_CACHE = 256
+
+# Oldest SQLite with the upserts the stats triggers and tag closure rely on.
+# Newer features are used only when present: AS MATERIALIZED needs 3.35
+MIN_SQLITE_VERSION = (3, 24, 0)
+CTE_MATERIALIZED = "AS MATERIALIZED" if sqlite3.sqlite_version_info >= (3, 35, 0) else "AS"
+
+# Single-writer queue: max pending writes, writes per commit, and how long
+# a request may wait to enqueue (backpressure) or for its result
+WRITE_QUEUE_DEPTH = int(os.environ.get("DYNOTES_WRITE_QUEUE_DEPTH", 256))
+WRITE_GROUP_COMMIT = 32
+WRITE_ENQUEUE_TIMEOUT = 2  # seconds
+WRITE_TIMEOUT = 30  # seconds
+
+# Hashes are precomputed so importing the app never runs a key derivation.
+# The defaults are for pw1..pw5 (and 1234); replace them with a JSON file of
+# {"vis_N": hash} named by DYNOTES_PASSWORDS_FILE, made with `flask hash-password`
+PASSWORD_HASH = "pbkdf2:sha256:260000$Vj8GwtMzW9pvFMED$844db62d0e5e7a408ff73312e7d1016c590f51400ac661c7bd4ccaa1ce85bb69"  # Initial password
+
+DEFAULT_PASSWORD_HASHES = {
+    "vis_1": "pbkdf2:sha256:260000$lkpSdfnhU7kMhsNt$b29b5d646b260813a89f304b9c9222daabb60679a6a33c3198bc18c0962b4275",
+    "vis_2": "pbkdf2:sha256:260000$I36si32zzfUmB2P2$2287f37f5915f6aa5add82d1c4c248b0a830a74581eba44996d84cb4c1636d6b",
+    "vis_3": "pbkdf2:sha256:260000$4Uv7Ibk6ADBKsiXS$786169b93ffd572261474b471a375d0cf8cf27f9017c5f49729dfaa8e57d3367",
+    "vis_4": "pbkdf2:sha256:260000$6WFfREpII6yquwnW$10e99f6b9450177c3ca00bce712e0e0f321b5f4e3a88ace8c72577bf135dbd79",
+    "vis_5": "pbkdf2:sha256:260000$NqQU9WCpuAecZ73w$4ed4ff3a583856959cc4341d71d403cc958d712dbfca313b07e86e45aca6cf66",
+}
 
-DATABASE = "notes.db"
-PASSWORD_HASH = generate_password_hash("1234")  # Initial password
 
+def load_password_hashes(path=None):
+    """Return the visibility password hashes, with any from the passwords file applied."""
+    hashes = dict(DEFAULT_PASSWORD_HASHES)
+    path = path or os.environ.get("DYNOTES_PASSWORDS_FILE")
+    if path:
+        with open(path) as f:
+            overrides = json.load(f)
+        unknown = set(overrides) - set(DEFAULT_PASSWORD_HASHES)
+        if unknown:
+            raise RuntimeError(f"Unknown visibility levels in {path}: {', '.join(sorted(unknown))}")
+        hashes.update(overrides)
+    return hashes
 
-PASSWORD_HASHES = {
-    "vis_1": generate_password_hash("pw1"),
-    "vis_2": generate_password_hash("pw2"),
-    "vis_3": generate_password_hash("pw3"),
-    "vis_4": generate_password_hash("pw4"),
-    "vis_5": generate_password_hash("pw5"),
-}
+
+PASSWORD_HASHES = load_password_hashes()
+
+# Cache of resolved visibility levels, so repeated searches don't re-run PBKDF2
+VISIBILITY_CACHE_SIZE = 1024
+VISIBILITY_CACHE_TTL = 300  # seconds
+
+# How long cached MMR candidate sets may be served before reloading
+MMR_SAMPLER_TTL = 60  # seconds
+
+# Lifetime of tokens handed out by /auth, and how many tags one may carry grants for
+TOKEN_MAX_AGE = 12 * 60 * 60  # seconds
+MAX_AUTH_TAGS = 20
+
+# /search results, keyed by normalized query and dropped whenever the data version moves
+SEARCH_CACHE_SIZE = int(os.environ.get("DYNOTES_SEARCH_CACHE_SIZE", 512))
+SEARCH_CACHE_MAX_BYTES = int(os.environ.get("DYNOTES_SEARCH_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+
+# Histogram buckets (seconds) for request, SQL and password timings on /metrics
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Statements slower than this are kept, with their query plan, for /admin/slow_queries
+SLOW_QUERY_THRESHOLD = float(os.environ.get("DYNOTES_SLOW_QUERY_MS", 100)) / 1000
+SLOW_QUERY_LOG_SIZE = 200
+
+# /changes feed: entries kept through compaction, how many new entries
+# trigger one, page size, and how often streams look for other workers' writes
+CHANGE_LOG_RETENTION = int(os.environ.get("DYNOTES_CHANGE_LOG_RETENTION", 10000))
+CHANGE_LOG_COMPACT_EVERY = 500
+CHANGES_PAGE_SIZE = 500
+CHANGES_POLL_INTERVAL = 1.0  # seconds
+CHANGES_KEEPALIVE = 15  # seconds
+
+# `flask serve`: worker processes, and how long a stopping worker waits for
+# in-flight requests and queued writes before exiting anyway
+SERVER_WORKERS = int(os.environ.get("DYNOTES_WORKERS", os.cpu_count() or 2))
+SERVER_DRAIN_TIMEOUT = 30  # seconds
+
+# Notes per write-queue job (and transaction) during bulk import
+IMPORT_CHUNK_SIZE = 1000
+MAX_IMPORT_ERRORS = 100
 
 import secrets
 import string
@@ -54,644 +154,3104 @@ def generate_tag_password_route():
 def generate_tag_password(tag_id, max_visibility=3):
     # Generate a random password
     password = "".join(secrets.choice(string.ascii_letters + string.digits) for _ in range(12))
+    password_hash = generate_password_hash(password)
 
     # Store the password hash and associated tag_id and max_visibility
-    db = get_db()
-    cursor = db.cursor()
-
-    try:
+    def insert_password(cursor):
         cursor.execute(
             """
             INSERT INTO TagPasswords (tag_id, password_hash, max_visibility)
             VALUES (?, ?, ?)
         """,
-            (tag_id, generate_password_hash(password), max_visibility),
+            (tag_id, password_hash, max_visibility),
         )
-        db.commit()
+
+    try:
+        get_write_queue().submit(insert_password)
+        clear_visibility_cache()
         return password
     except Exception as e:
-        db.rollback()
         app.logger.error(f"Error generating tag password: {str(e)}")
         return None
 
 
+def get_data_version(db):
+    row = db.execute("SELECT value FROM StatCounters WHERE name = 'data_version'").fetchone()
+    return row[0] if row else 0
+
+
+def get_membership_version(db):
+    row = db.execute("SELECT value FROM StatCounters WHERE name = 'membership_version'").fetchone()
+    return row[0] if row else 0
+
+
+def bump_data_version(cursor):
+    cursor.execute("UPDATE StatCounters SET value = value + 1 WHERE name = 'data_version'")
+
+
+# Serialized response bodies keyed by endpoint (and query), valid for one data
+# version; an LRU since export keys include the client's max_depth
+VERSIONED_BODIES_MAX = 32
+_versioned_bodies = OrderedDict()
+_versioned_bodies_lock = threading.Lock()
+
+
+def versioned_json(name, build):
+    """Serve build(db) as JSON with a strong ETag derived from the data version.
+
+    A matching If-None-Match gets a 304 without querying anything but the
+    version, and the serialized body is reused until the version changes.
+    """
+    db = get_read_db()
+    version = get_data_version(db)
+    etag = f"{name}-{version}"
+
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        with _versioned_bodies_lock:
+            cached = _versioned_bodies.get(name)
+            if cached is not None:
+                _versioned_bodies.move_to_end(name)
+        if cached is not None and cached[0] == version:
+            body = cached[1]
+        else:
+            body = json.dumps(build(db), separators=(",", ":")).encode("utf-8")
+            with _versioned_bodies_lock:
+                _versioned_bodies[name] = (version, body)
+                _versioned_bodies.move_to_end(name)
+                while len(_versioned_bodies) > VERSIONED_BODIES_MAX:
+                    _versioned_bodies.popitem(last=False)
+        response = app.response_class(body, mimetype="application/json")
+
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+def build_tag_export(db, max_depth=None, flat=False):
+    """Build the tag hierarchy in O(tags + relationships).
+
+    In the nested format every tag's subtree is expanded once, at the first
+    place a depth-first walk from the roots reaches it. Later occurrences (a
+    second parent in the DAG) and back edges of legacy cycles become
+    {"ref": true} stubs, and nodes cut off by max_depth get "truncated": true.
+    The flat format lists every tag with its child ids instead.
+    """
+    cursor = db.execute("SELECT tag_id, name, readable_id FROM Tags ORDER BY tag_id")
+    tags = {row["tag_id"]: dict(row) for row in cursor.fetchall()}
+
+    children = {tag_id: [] for tag_id in tags}
+    has_parent = set()
+    for parent_id, child_id in db.execute("SELECT parent_tag_id, child_tag_id FROM TagRelationships ORDER BY parent_tag_id, child_tag_id"):
+        if parent_id in tags and child_id in tags:
+            children[parent_id].append(child_id)
+            has_parent.add(child_id)
+
+    roots = [tag_id for tag_id in tags if tag_id not in has_parent]
+
+    if flat:
+        return {
+            "roots": roots,
+            "tags": [dict(tag, children=children[tag_id]) for tag_id, tag in tags.items()],
+        }
+
+    expanded = set()
+
+    def build(root_id):
+        root = dict(tags[root_id])
+        stack = [(root_id, root, 0)]
+        while stack:
+            tag_id, node, depth = stack.pop()
+            if tag_id in expanded:
+                node["ref"] = True
+                continue
+            if not children[tag_id]:
+                expanded.add(tag_id)
+                continue
+            if max_depth is not None and depth >= max_depth:
+                node["truncated"] = True
+                continue
+            expanded.add(tag_id)
+            node["children"] = [dict(tags[child_id]) for child_id in children[tag_id]]
+            for child_id, child in zip(reversed(children[tag_id]), reversed(node["children"])):
+                stack.append((child_id, child, depth + 1))
+        return root
+
+    reachable = set()
+
+    def mark_reachable(tag_id):
+        frontier = [tag_id]
+        reachable.add(tag_id)
+        while frontier:
+            for child_id in children[frontier.pop()]:
+                if child_id not in reachable:
+                    reachable.add(child_id)
+                    frontier.append(child_id)
+
+    result = []
+    for tag_id in roots:
+        result.append(build(tag_id))
+        mark_reachable(tag_id)
+
+    # Tags that only sit on a cycle have no root above them; surface them too
+    for tag_id in tags:
+        if tag_id not in reachable:
+            result.append(build(tag_id))
+            mark_reachable(tag_id)
+
+    return result
+
+
 @app.route("/export_tags_and_relationships", methods=["GET"])
 def export_tags_and_relationships():
-    db = get_db()
+    max_depth = request.args.get("max_depth", type=int)
+    if max_depth is not None and max_depth < 0:
+        return jsonify({"error": "max_depth must be zero or more"}), 400
+    flat = request.args.get("format") == "flat"
+    if flat:
+        # The flat format ignores max_depth, so don't cache it once per value
+        max_depth = None
+    return versioned_json(f"export-{'flat' if flat else 'tree'}-{max_depth}", lambda db: build_tag_export(db, max_depth, flat))
+
+
+@app.route("/graph", methods=["GET"])
+def get_graph():
+    """Tags, edges and per-tag note counts in one payload for the graph view."""
+
+    def build(db):
+        cursor = db.execute(
+            """
+            SELECT Tags.tag_id, Tags.name, Tags.readable_id, COALESCE(TagUsage.usage_count, 0) AS note_count
+            FROM Tags
+            LEFT JOIN TagUsage ON TagUsage.tag_id = Tags.tag_id
+        """
+        )
+        tags = [dict(row) for row in cursor.fetchall()]
+        edges = [list(row) for row in db.execute("SELECT parent_tag_id, child_tag_id FROM TagRelationships")]
+        return {"tags": tags, "edges": edges}
+
+    return versioned_json("graph", build)
+
+
+class VisibilityCache:
+    """Bounded LRU of resolved visibility levels with a TTL.
+
+    Entries are keyed on an HMAC of the password (with a per-process key) so
+    plaintext passwords are never kept in memory longer than the request.
+    They are only valid for the auth epoch they were resolved under; callers
+    pass the database's current one, and a newer epoch drops everything.
+    """
+
+    def __init__(self, max_size=VISIBILITY_CACHE_SIZE, ttl=VISIBILITY_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._key = secrets.token_bytes(32)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hashes_fingerprint = None
+        self.epoch = None
+
+    def digest(self, password):
+        return hmac.new(self._key, password.encode("utf-8"), hashlib.sha256).digest()
+
+    def _sync(self, epoch):
+        # Global hashes can be swapped at runtime; drop everything if they did.
+        # Returns False for a caller holding an epoch older than the cache's.
+        fingerprint = tuple(sorted(PASSWORD_HASHES.items()))
+        if fingerprint != self._hashes_fingerprint:
+            self._entries.clear()
+            self._hashes_fingerprint = fingerprint
+        if self.epoch is None or epoch > self.epoch:
+            self._entries.clear()
+            self.epoch = epoch
+        return epoch == self.epoch
+
+    def get(self, key, epoch):
+        with self._lock:
+            if not self._sync(epoch):
+                return None
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            level, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return level
+
+    def set(self, key, level, epoch):
+        with self._lock:
+            if not self._sync(epoch):
+                return
+            self._entries[key] = (level, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+visibility_cache = VisibilityCache()
 
-    # Get all tags
-    cursor = db.execute("SELECT tag_id, name, readable_id FROM Tags")
-    tags = {row["tag_id"]: dict(row) for row in cursor.fetchall()}
 
-    # Get all relationships
-    cursor = db.execute("SELECT parent_tag_id, child_tag_id FROM TagRelationships")
-    relationships = cursor.fetchall()
+def clear_visibility_cache():
+    """Drop this process's cached levels; TagPasswords changes also move the shared auth epoch."""
+    visibility_cache.clear()
 
-    # Build the hierarchy
-    for parent_id, child_id in relationships:
-        if "children" not in tags[parent_id]:
-            tags[parent_id]["children"] = []
-        tags[parent_id]["children"].append(tags[child_id])
 
-    # Filter out child tags from the top level
-    root_tags = {id: tag for id, tag in tags.items() if not any(id == rel[1] for rel in relationships)}
+def get_auth_epoch(db):
+    row = db.execute("SELECT value FROM StatCounters WHERE name = 'auth_epoch'").fetchone()
+    return row[0] if row else 0
 
-    return jsonify(list(root_tags.values()))
+
+def password_hashes_fingerprint():
+    # Short digest of the global hashes, so tokens die with the passwords they were issued for
+    return hashlib.sha256(json.dumps(sorted(PASSWORD_HASHES.items())).encode("utf-8")).hexdigest()[:16]
 
 
 def get_visibility_level(password, tag_id=None):
-    # Check global passwords first
+    # The global level is cached on its own, so a tag seen for the first time
+    # only costs that tag's hashes rather than the five global ones again
+    level = _cached_visibility_level(password, None)
+    if not level and tag_id:
+        level = _cached_visibility_level(password, tag_id)
+    return level or 1  # Default visibility level
+
+
+def _cached_visibility_level(password, tag_id):
+    key = (visibility_cache.digest(password), tag_id)
+    epoch = get_auth_epoch(get_read_db())
+    level = visibility_cache.get(key, epoch)
+    if level is None:
+        metrics.inc("dynotes_visibility_cache_total", result="miss")
+        started = time.perf_counter()
+        level = _resolve_tag_level(password, tag_id) if tag_id else _resolve_global_level(password)
+        metrics.observe("dynotes_password_check_seconds", time.perf_counter() - started)
+        visibility_cache.set(key, level, epoch)
+    else:
+        metrics.inc("dynotes_visibility_cache_total", result="hit")
+    return level
+
+
+def _resolve_global_level(password):
+    """Return the level of the matching global password, or 0 if none match."""
     for level in range(5, 0, -1):
         if check_password_hash(PASSWORD_HASHES[f"vis_{level}"], password):
             return level
+    return 0
 
-    # Check tag-specific password if tag_id is provided
-    if tag_id:
-        try:
-            db = get_db()
-            cursor = db.cursor()
-            cursor.execute(
-                """
-                SELECT max_visibility FROM TagPasswords
-                WHERE tag_id = ? AND password_hash = ?
-            """,
-                (tag_id, generate_password_hash(password)),
-            )
-            result = cursor.fetchone()
-            if result:
-                return result["max_visibility"]
-        except sqlite3.OperationalError as e:
-            if "no such table: TagPasswords" in str(e):
-                # TagPasswords table doesn't exist, log the error and continue
-                app.logger.warning("TagPasswords table does not exist yet.")
-            else:
-                # Some other SQLite error occurred, re-raise it
-                raise
 
-    return 1  # Default visibility level
+def _resolve_tag_level(password, tag_id):
+    """Return the max_visibility of the matching password for tag_id, or 0."""
+    try:
+        db = get_read_db()
+        cursor = db.cursor()
+        cursor.execute(
+            """
+            SELECT password_hash, max_visibility FROM TagPasswords
+            WHERE tag_id = ?
+            ORDER BY max_visibility DESC
+        """,
+            (tag_id,),
+        )
+        # Hashes are salted, so each stored hash has to be checked in turn
+        for row in cursor.fetchall():
+            if check_password_hash(row["password_hash"], password):
+                return row["max_visibility"]
+    except sqlite3.OperationalError as e:
+        if "no such table: TagPasswords" in str(e):
+            # TagPasswords table doesn't exist, log the error and continue
+            app.logger.warning("TagPasswords table does not exist yet.")
+        else:
+            # Some other SQLite error occurred, re-raise it
+            raise
+    return 0
+
 
+token_serializer = URLSafeTimedSerializer(app.secret_key, salt="dynotes-access-token")
+
+
+def issue_access_token(password, tag_ids=()):
+    """Verify the password once and sign the resolved grants into a token.
+
+    Tag passwords are only tried for the tags asked for (at most
+    MAX_AUTH_TAGS), each through the visibility cache, so a wrong password
+    costs a bounded number of hash checks.
+    """
+    # Read before the grants, so a password change in between revokes the token rather than being missed
+    epoch = get_auth_epoch(get_read_db())
+    level = get_visibility_level(password)
+    grants = {}
+    for tag_id in tag_ids:
+        tag_level = _cached_visibility_level(password, tag_id)
+        if tag_level > level:
+            grants[tag_id] = tag_level
+
+    payload = {"v": level, "g": {str(tag_id): lvl for tag_id, lvl in grants.items()}, "e": epoch, "h": password_hashes_fingerprint()}
+    return token_serializer.dumps(payload), level, grants
+
+
+def load_access_token(token):
+    """Return the token payload, or None if it is forged, expired or revoked."""
+    try:
+        payload = token_serializer.loads(token, max_age=TOKEN_MAX_AGE)
+    except (SignatureExpired, BadSignature):
+        return None
+    if payload.get("e") != get_auth_epoch(get_read_db()) or payload.get("h") != password_hashes_fingerprint():
+        return None
+    return payload
+
+
+def request_visibility_level(data, selected_tags=()):
+    """Resolve the caller's visibility level from a token or a raw password.
+
+    Returns None when a token was supplied but is not valid.
+    """
+    token = data.get("token")
+    if token:
+        payload = load_access_token(token)
+        if payload is None:
+            return None
+        level = payload["v"]
+        grants = payload["g"]
+        if selected_tags:
+            return max(grants.get(str(tag_id), level) for tag_id in selected_tags)
+        return level
+
+    password = data.get("password", "")
+    if selected_tags:
+        return max(get_visibility_level(password, tag_id) for tag_id in selected_tags)
+    return get_visibility_level(password)
+
+
+def query_visibility_level():
+    """request_visibility_level for a GET request, from its ?token= alone.
+
+    Query strings end up in access logs, proxies and browser history, so
+    callers refuse a ?password= with a 400 before getting here.
+    """
+    return request_visibility_level({"token": request.args.get("token")})
 
-@app.route("/get_stats", methods=["GET"])
-def get_stats():
-    db = get_db()
-    cursor = db.cursor()
 
-    # Get total number of notes
-    cursor.execute("SELECT COUNT(*) FROM Notes")
-    note_count = cursor.fetchone()[0]
+PASSWORD_IN_QUERY_ERROR = "Passwords are not accepted in the query string; exchange one for a token at /auth"
 
-    # Get total number of tags
-    cursor.execute("SELECT COUNT(*) FROM Tags")
-    tag_count = cursor.fetchone()[0]
 
-    # Get number of tag relationships
-    cursor.execute("SELECT COUNT(*) FROM TagRelationships")
-    relationship_count = cursor.fetchone()[0]
+@app.route("/auth", methods=["POST"])
+def auth():
+    data = request.json
+    password = data.get("password", "")
+    tag_ids = data.get("tags") or []
+    if not isinstance(tag_ids, list) or len(tag_ids) > MAX_AUTH_TAGS or not all(isinstance(tag_id, int) for tag_id in tag_ids):
+        return jsonify({"success": False, "error": f"tags must be a list of at most {MAX_AUTH_TAGS} tag ids"}), 400
+    token, level, grants = issue_access_token(password, tag_ids)
+    return jsonify({"success": True, "token": token, "visibility": level, "tag_grants": grants, "expires_in": TOKEN_MAX_AGE})
 
-    # Get average note rating
-    cursor.execute("SELECT AVG(rating) FROM Notes")
-    avg_rating = cursor.fetchone()[0]
 
-    # Get number of notes for each visibility level
-    cursor.execute("SELECT visibility, COUNT(*) FROM Notes GROUP BY visibility ORDER BY visibility")
-    visibility_counts = dict(cursor.fetchall())
+def read_stats(cursor):
+    """Assemble /get_stats from the trigger-maintained counter tables."""
+    cursor.execute("SELECT name, value FROM StatCounters")
+    counters = dict(cursor.fetchall())
 
+    cursor.execute("SELECT visibility, note_count FROM StatVisibility WHERE note_count > 0 ORDER BY visibility")
+    # String keys, as JSON would have them anyway, so "null" sorts alongside the levels
+    visibility_counts = {str(level): count for level, count in cursor.fetchall()}
+    if counters.get("null_visibility_count"):
+        visibility_counts["null"] = counters["null_visibility_count"]
+
+    # Notes from the last week; a covering range scan on idx_notes_date_sort
     cursor.execute("SELECT COUNT(*) FROM Notes WHERE date >= ?", (int(time.time()) - 7 * 24 * 60 * 60,))
     recent_notes = cursor.fetchone()[0]
 
+    # Get top 5 tags by usage, straight off idx_tag_usage_count
     cursor.execute(
         """
-        SELECT Tags.name, COUNT(*) as usage_count
-        FROM NoteTags
-        JOIN Tags ON NoteTags.tag_id = Tags.tag_id
-        GROUP BY NoteTags.tag_id
-        ORDER BY usage_count DESC
+        SELECT Tags.name, TagUsage.usage_count
+        FROM TagUsage
+        JOIN Tags ON TagUsage.tag_id = Tags.tag_id
+        WHERE TagUsage.usage_count > 0
+        ORDER BY TagUsage.usage_count DESC
         LIMIT 5
     """
     )
     top_tags = [{"name": row[0], "count": row[1]} for row in cursor.fetchall()]
-    # Get top 5 tags by usage
 
-    return jsonify(
-        {
-            "note_count": note_count,
-            "tag_count": tag_count,
-            "relationship_count": relationship_count,
-            "avg_rating": round(avg_rating, 2) if avg_rating else 0,
-            "visibility_counts": visibility_counts,
-            "top_tags": top_tags,
-            "recent_notes": recent_notes,
-        }
+    rating_count = counters.get("rating_count", 0)
+    avg_rating = counters.get("rating_sum", 0) / rating_count if rating_count else 0
+
+    return {
+        "note_count": counters.get("note_count", 0),
+        "tag_count": counters.get("tag_count", 0),
+        "relationship_count": counters.get("relationship_count", 0),
+        "avg_rating": round(avg_rating, 2) if avg_rating else 0,
+        "visibility_counts": visibility_counts,
+        "top_tags": top_tags,
+        "recent_notes": recent_notes,
+    }
+
+
+def rebuild_stats(cursor):
+    """Recount everything from the base tables and overwrite the counters.
+
+    Returns {counter: (stored, recounted)} for every counter that had drifted.
+    """
+    cursor.execute(
+        """
+        SELECT 'note_count', COUNT(*) FROM Notes
+        UNION ALL SELECT 'tag_count', COUNT(*) FROM Tags
+        UNION ALL SELECT 'relationship_count', COUNT(*) FROM TagRelationships
+        UNION ALL SELECT 'rating_sum', COALESCE(SUM(rating), 0) FROM Notes
+        UNION ALL SELECT 'rating_count', COUNT(rating) FROM Notes
+    """
     )
+    counters = dict(cursor.fetchall())
+    cursor.execute("SELECT visibility, COUNT(*) FROM Notes GROUP BY visibility")
+    visibility = dict(cursor.fetchall())
+    # StatVisibility can't key on NULL, so those notes have a counter of their own
+    counters["null_visibility_count"] = visibility.pop(None, 0)
+    cursor.execute("SELECT tag_id, COUNT(*) FROM NoteTags GROUP BY tag_id")
+    usage = dict(cursor.fetchall())
+
+    drift = {}
+    cursor.execute("SELECT name, value FROM StatCounters")
+    for name, value in cursor.fetchall():
+        if name in counters and counters[name] != value:
+            drift[name] = (value, counters.get(name, 0))
+    cursor.execute("SELECT visibility, note_count FROM StatVisibility WHERE note_count != 0")
+    stored_visibility = dict(cursor.fetchall())
+    for level in set(stored_visibility) | set(visibility):
+        if stored_visibility.get(level, 0) != visibility.get(level, 0):
+            drift[f"visibility_{level}"] = (stored_visibility.get(level, 0), visibility.get(level, 0))
+    cursor.execute("SELECT tag_id, usage_count FROM TagUsage WHERE usage_count != 0")
+    stored_usage = dict(cursor.fetchall())
+    for tag_id in set(stored_usage) | set(usage):
+        if stored_usage.get(tag_id, 0) != usage.get(tag_id, 0):
+            drift[f"tag_{tag_id}"] = (stored_usage.get(tag_id, 0), usage.get(tag_id, 0))
+    cursor.executemany("INSERT OR REPLACE INTO StatCounters (name, value) VALUES (?, ?)", counters.items())
+    cursor.execute("DELETE FROM StatVisibility")
+    cursor.executemany("INSERT INTO StatVisibility (visibility, note_count) VALUES (?, ?)", visibility.items())
+    cursor.execute("DELETE FROM TagUsage")
+    cursor.executemany("INSERT INTO TagUsage (tag_id, usage_count) VALUES (?, ?)", usage.items())
+    return drift
+
+
+@app.route("/get_stats", methods=["GET"])
+def get_stats():
+    db = get_read_db()
+    return jsonify(read_stats(db.cursor()))
+
+
+@app.route("/rebuild_stats", methods=["POST"])
+def rebuild_stats_route():
+    try:
+        drift = get_write_queue().submit(rebuild_stats)
+    except WriteUnavailable as e:
+        return jsonify({"success": False, "error": str(e)}), 503
+    except Exception as e:
+        app.logger.error(f"Error rebuilding stats: {str(e)}")
+        return jsonify({"success": False, "error": str(e)}), 500
+
+    if drift:
+        app.logger.warning(f"Stat counters had drifted: {drift}")
+    db = get_read_db()
+    return jsonify({"success": True, "drift": {name: {"stored": stored, "recounted": recounted} for name, (stored, recounted) in drift.items()}, "stats": read_stats(db.cursor())})
+
+
+@app.cli.command("rebuild-stats")
+def rebuild_stats_command():
+    """Recount /get_stats counters and report any drift."""
+    db = get_db()
+    drift = rebuild_stats(db.cursor())
+    bump_data_version(db.cursor())
+    db.commit()
+    print(f"Stats rebuilt, {len(drift)} counters had drifted.")
+    for name, (stored, recounted) in sorted(drift.items()):
+        print(f"  {name}: {stored} -> {recounted}")
 
 
 @app.route("/tags", methods=["GET"])
 def get_tags():
-    db = get_db()
-    cursor = db.execute("SELECT tag_id, name, readable_id FROM Tags")
-    tags = [dict(row) for row in cursor.fetchall()]
-    return jsonify(tags)
+    def build(db):
+        cursor = db.execute("SELECT tag_id, name, readable_id FROM Tags")
+        return [dict(row) for row in cursor.fetchall()]
+
+    return versioned_json("tags", build)
 
 
 @app.route("/tag_relationships", methods=["GET"])
 def get_tag_relationships():
-    db = get_db()
-    cursor = db.execute("SELECT parent_tag_id, child_tag_id FROM TagRelationships")
-    relationships = [dict(row) for row in cursor.fetchall()]
-    return jsonify(relationships)
+    def build(db):
+        cursor = db.execute("SELECT parent_tag_id, child_tag_id FROM TagRelationships")
+        return [dict(row) for row in cursor.fetchall()]
+
+    return versioned_json("tag_relationships", build)
 
 
 @app.route("/rename_tag", methods=["POST"])
 def rename_tag():
-    db = get_db()
     data = request.json
-    cursor = db.cursor()
 
-    try:
+    def rename(cursor):
         cursor.execute("UPDATE Tags SET name = ? WHERE tag_id = ?", (data["new_name"], data["tag_id"]))
-        db.commit()
+        refresh_tag_names(cursor, tag_id=data["tag_id"])
+        log_tag_change(cursor, data["tag_id"])
+        log_note_changes(cursor, tag_id=data["tag_id"])
+
+    try:
+        get_write_queue().submit(rename)
         return jsonify({"success": True})
+    except WriteUnavailable as e:
+        return jsonify({"success": False, "error": str(e)}), 503
     except Exception as e:
-        db.rollback()
         return jsonify({"success": False, "error": str(e)}), 500
 
 
+def refresh_tag_names(cursor, note_ids=None, tag_id=None):
+    """Recompute the denormalized Notes.tag_names.
+
+    Pass note_ids for specific notes, tag_id for every note carrying that
+    tag, or neither to rebuild all notes. Each form is a single UPDATE.
+    """
+    query = """
+    UPDATE Notes SET tag_names = (
+        SELECT GROUP_CONCAT(t.name)
+        FROM NoteTags nt JOIN Tags t ON t.tag_id = nt.tag_id
+        WHERE nt.note_id = Notes.note_id
+    )"""
+    params = ()
+    if note_ids is not None:
+        note_ids = list(note_ids)
+        if not note_ids:
+            return
+        # json_each keeps large id lists clear of the bound-variable limit
+        query += " WHERE note_id IN (SELECT value FROM json_each(?))"
+        params = (json.dumps(note_ids),)
+    elif tag_id is not None:
+        query += " WHERE note_id IN (SELECT note_id FROM NoteTags WHERE tag_id = ?)"
+        params = (tag_id,)
+    cursor.execute(query, params)
+
+
+def _delete_tag(cursor, tag_id):
+    # Remember who could reach other tags through this one
+    cursor.execute("SELECT ancestor_id FROM TagClosure WHERE descendant_id = ? AND ancestor_id != ?", (tag_id, tag_id))
+    ancestor_ids = [row["ancestor_id"] for row in cursor.fetchall()]
+
+    # Delete relationships where this tag is a parent or child
+    cursor.execute("SELECT parent_tag_id, child_tag_id FROM TagRelationships WHERE parent_tag_id = ? OR child_tag_id = ?", (tag_id, tag_id))
+    for parent_id, child_id in cursor.fetchall():
+        log_change(cursor, "relationship", f"{parent_id}:{child_id}", "delete")
+    cursor.execute("DELETE FROM TagRelationships WHERE parent_tag_id = ? OR child_tag_id = ?", (tag_id, tag_id))
+
+    # Drop the tag from the closure and re-derive what its ancestors can still reach
+    cursor.execute("DELETE FROM TagClosure WHERE ancestor_id = ? OR descendant_id = ?", (tag_id, tag_id))
+    recompute_tag_closure(cursor, ancestor_ids)
+
+    # Delete note-tag associations, then drop the name from those notes' tag lists
+    cursor.execute("SELECT note_id FROM NoteTags WHERE tag_id = ?", (tag_id,))
+    note_ids = [row["note_id"] for row in cursor.fetchall()]
+    cursor.execute("DELETE FROM NoteTags WHERE tag_id = ?", (tag_id,))
+    refresh_tag_names(cursor, note_ids)
+    log_note_changes(cursor, note_ids)
+
+    # Delete passwords scoped to this tag
+    cursor.execute("DELETE FROM TagPasswords WHERE tag_id = ?", (tag_id,))
+
+    # Delete the tag last, once nothing references it
+    cursor.execute("DELETE FROM Tags WHERE tag_id = ?", (tag_id,))
+    log_change(cursor, "tag", tag_id, "delete")
+    write_queue = get_write_queue()
+    write_queue.after_commit(tag_index.remove_tag, tag_id)
+    write_queue.after_commit(tag_index.set_closure, read_tag_closure(cursor))
+
+
 @app.route("/delete_tag", methods=["POST"])
 def delete_tag():
-    db = get_db()
     data = request.json
-    cursor = db.cursor()
 
     try:
-        # Begin a transaction
-        cursor.execute("BEGIN")
-
-        # Delete the tag
-        cursor.execute("DELETE FROM Tags WHERE tag_id = ?", (data["tag_id"],))
-
-        # Delete relationships where this tag is a parent or child
-        cursor.execute("DELETE FROM TagRelationships WHERE parent_tag_id = ? OR child_tag_id = ?", (data["tag_id"], data["tag_id"]))
-
-        # Delete note-tag associations
-        cursor.execute("DELETE FROM NoteTags WHERE tag_id = ?", (data["tag_id"],))
-
-        # Commit the transaction
-        db.commit()
+        get_write_queue().submit(_delete_tag, data["tag_id"])
+        mmr_sampler.invalidate()
+        clear_visibility_cache()
         return jsonify({"success": True})
+    except WriteUnavailable as e:
+        return jsonify({"success": False, "error": str(e)}), 503
     except Exception as e:
-        db.rollback()
         app.logger.error(f"Error deleting tag: {str(e)}")
         return jsonify({"success": False, "error": str(e)}), 500
 
 
+def _remove_tag_relationship(cursor, parent_id, child_id):
+    cursor.execute("SELECT ancestor_id FROM TagClosure WHERE descendant_id = ?", (parent_id,))
+    ancestor_ids = [row["ancestor_id"] for row in cursor.fetchall()]
+
+    cursor.execute("DELETE FROM TagRelationships WHERE parent_tag_id = ? AND child_tag_id = ?", (parent_id, child_id))
+    recompute_tag_closure(cursor, ancestor_ids)
+    log_change(cursor, "relationship", f"{parent_id}:{child_id}", "delete")
+    get_write_queue().after_commit(tag_index.set_closure, read_tag_closure(cursor))
+
+
 @app.route("/remove_tag_relationship", methods=["POST"])
 def remove_tag_relationship():
-    db = get_db()
     data = request.json
-    cursor = db.cursor()
 
     try:
-        cursor.execute("DELETE FROM TagRelationships WHERE parent_tag_id = ? AND child_tag_id = ?", (data["parent_id"], data["child_id"]))
-        db.commit()
+        get_write_queue().submit(_remove_tag_relationship, data["parent_id"], data["child_id"])
+        mmr_sampler.invalidate()
         return jsonify({"success": True})
+    except WriteUnavailable as e:
+        return jsonify({"success": False, "error": str(e)}), 503
     except Exception as e:
-        db.rollback()
         return jsonify({"success": False, "error": str(e)}), 500
 
 
+def _add_tag(cursor, name, readable_id):
+    cursor.execute("INSERT INTO Tags (name, readable_id) VALUES (?, ?)", (name, readable_id))
+    tag_id = cursor.lastrowid
+    cursor.execute("INSERT INTO TagClosure (ancestor_id, descendant_id, depth) VALUES (?, ?, 0)", (tag_id, tag_id))
+    log_tag_change(cursor, tag_id)
+    return tag_id
+
+
 @app.route("/add_tag", methods=["POST"])
 def add_tag():
-    db = get_db()
     data = request.json
-    cursor = db.cursor()
 
     try:
-        cursor.execute("INSERT INTO Tags (name, readable_id) VALUES (?, ?)", (data["name"], data["readable_id"]))
-        tag_id = cursor.lastrowid
-
-        db.commit()
+        tag_id = get_write_queue().submit(_add_tag, data["name"], data["readable_id"])
         return jsonify({"success": True, "tag_id": tag_id})
+    except WriteUnavailable as e:
+        return jsonify({"success": False, "error": str(e)}), 503
     except Exception as e:
-        db.rollback()
         return jsonify({"success": False, "error": str(e)}), 500
 
 
+def _add_tag_relationship(cursor, parent_id, child_id):
+    add_tag_closure_edge(cursor, parent_id, child_id)
+    cursor.execute("INSERT INTO TagRelationships (parent_tag_id, child_tag_id) VALUES (?, ?)", (parent_id, child_id))
+    log_change(cursor, "relationship", f"{parent_id}:{child_id}", "upsert", {"parent_id": parent_id, "child_id": child_id})
+    get_write_queue().after_commit(tag_index.set_closure, read_tag_closure(cursor))
+
+
 @app.route("/update_tag_relationships", methods=["POST"])
 def update_tag_relationships():
-    db = get_db()
     data = request.json
-    cursor = db.cursor()
 
     try:
         # Add new relationship
-        cursor.execute("INSERT INTO TagRelationships (parent_tag_id, child_tag_id) VALUES (?, ?)", (data["parent_id"], data["child_id"]))
-
-        db.commit()
+        get_write_queue().submit(_add_tag_relationship, data["parent_id"], data["child_id"])
+        mmr_sampler.invalidate()
         return jsonify({"success": True})
+    except TagCycleError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    except WriteUnavailable as e:
+        return jsonify({"success": False, "error": str(e)}), 503
     except Exception as e:
-        db.rollback()
         return jsonify({"success": False, "error": str(e)}), 500
 
 
-def get_db():
-    if "db" not in g:
-        g.db = sqlite3.connect(DATABASE)
-        g.db.row_factory = sqlite3.Row
-    return g.db
-
-
-@app.teardown_appcontext
-def close_db(error):
-    if hasattr(g, "db"):
-        g.db.close()
+class TagCycleError(Exception):
+    pass
 
 
-def init_db():
-    if not os.path.exists(DATABASE):
-        with app.app_context():
-            db = get_db()
-            with app.open_resource("schema.sql", mode="r") as f:
-                db.cursor().executescript(f.read())
-            db.commit()
-        app.logger.info("Database initialized.")
-    else:
-        app.logger.info("Database already exists, skipping initialization.")
+def add_tag_closure_edge(cursor, parent_id, child_id):
+    """Connect every ancestor of parent_id to every descendant of child_id.
 
+    Raises TagCycleError if child_id can already reach parent_id.
+    """
+    cursor.execute("SELECT 1 FROM TagClosure WHERE ancestor_id = ? AND descendant_id = ?", (child_id, parent_id))
+    if parent_id == child_id or cursor.fetchone():
+        raise TagCycleError("Relationship would create a cycle")
 
-@app.route("/")
-def index():
-    return render_template("index.html")
+    cursor.execute(
+        """
+        INSERT INTO TagClosure (ancestor_id, descendant_id, depth)
+        SELECT a.ancestor_id, d.descendant_id, a.depth + 1 + d.depth
+        FROM TagClosure a, TagClosure d
+        WHERE a.descendant_id = ? AND d.ancestor_id = ?
+        ON CONFLICT (ancestor_id, descendant_id) DO UPDATE SET depth = MIN(depth, excluded.depth)
+    """,
+        (parent_id, child_id),
+    )
 
 
-@app.route("/edit_note", methods=["POST"])
-def edit_note():
+def recompute_tag_closure(cursor, ancestor_ids=None):
+    """Re-derive the closure rows of the given ancestors (all tags if None) from TagRelationships."""
+    if ancestor_ids is None:
+        cursor.execute("DELETE FROM TagClosure")
+        seed = "SELECT tag_id, tag_id, 0 FROM Tags"
+        params = []
+    elif not ancestor_ids:
+        return
+    else:
+        placeholders = ",".join("?" for _ in ancestor_ids)
+        cursor.execute(f"DELETE FROM TagClosure WHERE ancestor_id IN ({placeholders})", ancestor_ids)
+        seed = f"SELECT tag_id, tag_id, 0 FROM Tags WHERE tag_id IN ({placeholders})"
+        params = list(ancestor_ids)
 
-    db = get_db()
-    data = request.json
-    cursor = db.cursor()
+    # The depth bound keeps the walk finite even if old data contains a cycle
+    cursor.execute(
+        f"""
+        WITH RECURSIVE
+        walk(ancestor_id, descendant_id, depth) AS (
+            {seed}
+            UNION
+            SELECT w.ancestor_id, tr.child_tag_id, w.depth + 1
+            FROM walk w
+            JOIN TagRelationships tr ON tr.parent_tag_id = w.descendant_id
+            WHERE w.depth < (SELECT COUNT(*) FROM Tags)
+        )
+        INSERT INTO TagClosure (ancestor_id, descendant_id, depth)
+        SELECT ancestor_id, descendant_id, MIN(depth) FROM walk GROUP BY ancestor_id, descendant_id
+    """,
+        params,
+    )
 
-    try:
-        cursor.execute("BEGIN")
-
-        # Fetch the current note data
-        cursor.execute("SELECT * FROM Notes WHERE note_id = ?", (data["noteId"],))
-        current_note = cursor.fetchone()
-
-        if not current_note:
-            raise Exception("Note not found")
-
-        # Prepare the update fields
-        update_fields = []
-        update_values = []
-        for field in ["text", "author", "rating", "source", "visibility"]:
-            if field in data:
-                update_fields.append(f"{field} = ?")
-                update_values.append(data[field])
-
-        # Only proceed with update if there are fields to update
-        if update_fields:
-            # Construct and execute the update query
-            update_query = f"""
-            UPDATE Notes
-            SET {', '.join(update_fields)}
-            WHERE note_id = ?
-            """
-            update_values.append(data["noteId"])
-            cursor.execute(update_query, update_values)
 
-        # Update tags only if they're provided
-        if "tags" in data:
-            # Delete existing tag associations
-            cursor.execute("DELETE FROM NoteTags WHERE note_id = ?", (data["noteId"],))
+def read_tag_closure(cursor):
+    """All (ancestor_id, descendant_id) pairs, for handing the new hierarchy to the tag index."""
+    cursor.execute("SELECT ancestor_id, descendant_id FROM TagClosure")
+    return [tuple(row) for row in cursor.fetchall()]
 
-            # Add new tag associations
-            for tag_id in data["tags"]:
-                cursor.execute("INSERT INTO NoteTags (note_id, tag_id) VALUES (?, ?)", (data["noteId"], tag_id))
 
-        db.commit()
-        return jsonify({"success": True})
-    except Exception as e:
-        db.rollback()
-        app.logger.error(f"Error editing note: {str(e)}")
-        return jsonify({"success": False, "error": str(e)}), 500
+def rebuild_tag_closure(cursor):
+    recompute_tag_closure(cursor)
+    cursor.execute("SELECT COUNT(*) FROM TagClosure")
+    return cursor.fetchone()[0]
 
 
-@app.route("/get_mmr_notes", methods=["POST"])
-def get_mmr_notes():
+@app.cli.command("rebuild-tag-closure")
+def rebuild_tag_closure_command():
+    """Recompute TagClosure from scratch."""
     db = get_db()
-    data = request.json
-    selected_tags = data.get("tags", [])
-    password = data.get("password", "")
-
-    # visibility_level = 5 if check_password_hash(PASSWORD_HASH, password) else 1
-    visibility_level = get_visibility_level(password)
-    # New base query that doesn't rely on tag selection
-    base_query = """
-    SELECT n.note_id, n.text, n.author, n.date, n.rating, n.source, n.visibility, n.mmr, n.mmr_matches,
-           GROUP_CONCAT(DISTINCT t.name) as tags
-    FROM Notes n
-    LEFT JOIN NoteTags nt ON n.note_id = nt.note_id
-    LEFT JOIN Tags t ON nt.tag_id = t.tag_id
-    WHERE n.visibility <= ?
-    """
+    count = rebuild_tag_closure(db.cursor())
+    bump_data_version(db.cursor())
+    db.commit()
+    print(f"Tag closure rebuilt with {count} rows.")
+
+
+class Metrics:
+    """Process-local counters and histograms, rendered as Prometheus text."""
+
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._types = {}
+        self._help = {}
+        self._counters = {}
+        self._histograms = {}
+
+    def describe(self, name, kind, help_text):
+        self._types[name] = kind
+        self._help[name] = help_text
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # One slot per bucket, then sum and count
+                histogram = self._histograms[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[i] += 1
+                    break
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+        return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+    def render(self, gauges=()):
+        """Prometheus exposition text; gauges are extra (name, help, value) samples."""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, list(values)) for key, values in self._histograms.items())
+
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {self._help.get(name, name)}")
+                lines.append(f"# TYPE {name} {self._types.get(name, kind)}")
+
+        for (name, labels), value in counters:
+            header(name, "counter")
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), values in histograms:
+            header(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {values[-1]}")
+            lines.append(f"{name}_sum{self._labels(labels)} {values[-2]}")
+            lines.append(f"{name}_count{self._labels(labels)} {values[-1]}")
+        for name, help_text, value in gauges:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+metrics.describe("dynotes_request_seconds", "histogram", "Time spent handling HTTP requests")
+metrics.describe("dynotes_sql_seconds", "histogram", "Time spent executing SQL statements, by statement type")
+metrics.describe("dynotes_sql_fetch_seconds_total", "counter", "Time spent fetching rows from executed statements")
+metrics.describe("dynotes_password_check_seconds", "histogram", "Time spent verifying passwords on visibility cache misses")
+metrics.describe("dynotes_visibility_cache_total", "counter", "Visibility level lookups by cache result")
+metrics.describe("dynotes_slow_queries_total", "counter", "Statements slower than the slow query threshold")
+
+SQL_OPERATIONS = {"select", "insert", "update", "delete", "with", "replace", "begin", "commit", "rollback", "savepoint", "release", "pragma", "create", "drop", "analyze", "explain"}
+
+
+def sql_operation(sql):
+    words = sql.split(None, 1)
+    operation = words[0].lower() if words else ""
+    return operation if operation in SQL_OPERATIONS else "other"
+
+
+def normalize_sql(sql):
+    # Collapse whitespace and IN-lists so every tag count maps to one query shape
+    sql = " ".join(sql.split())
+    return re.sub(r"\?(\s*,\s*\?)+", "?, ...", sql)
+
+
+def parameter_shape(parameters):
+    """Describe parameters by type only, e.g. 'int*3, str', so no values are retained."""
+    if isinstance(parameters, dict):
+        return ", ".join(f"{name}:{type(value).__name__}" for name, value in sorted(parameters.items()))
+    runs = []
+    for value in parameters:
+        name = type(value).__name__
+        if runs and runs[-1][0] == name:
+            runs[-1][1] += 1
+        else:
+            runs.append([name, 1])
+    return ", ".join(name if count == 1 else f"{name}*{count}" for name, count in runs)
 
-    params = [visibility_level]
 
-    # If tags are selected, add tag filtering
-    if selected_tags:
-        tag_query = """
-        WITH RECURSIVE
-        tag_hierarchy(root_id, descendant_id) AS (
-            SELECT tag_id, tag_id FROM Tags WHERE tag_id IN ({})
-            UNION
-            SELECT th.root_id, tr.child_tag_id
-            FROM tag_hierarchy th
-            JOIN TagRelationships tr ON th.descendant_id = tr.parent_tag_id
-        )
-        SELECT n.note_id
-        FROM Notes n
-        JOIN NoteTags nt ON n.note_id = nt.note_id
-        JOIN tag_hierarchy th ON nt.tag_id = th.descendant_id
-        GROUP BY n.note_id
-        HAVING COUNT(DISTINCT th.root_id) = ?
-        """
-        tag_placeholders = ",".join("?" for _ in selected_tags)
-        tag_query = tag_query.format(tag_placeholders)
-        base_query = f"{base_query} AND n.note_id IN ({tag_query})"
-        params.extend(selected_tags)
-        params.append(len(selected_tags))
+class SlowQueryLog:
+    """Ring buffer of statements that exceeded SLOW_QUERY_THRESHOLD.
 
-    # Finalize the query
-    query = f"""
-    {base_query}
-    GROUP BY n.note_id
-    ORDER BY RANDOM()
-    LIMIT 2
+    Each entry carries the normalized SQL, the parameter shape, the duration
+    and the EXPLAIN QUERY PLAN output. Plans are looked up once per query
+    shape and reused, so a hot slow query doesn't pay for EXPLAIN each time.
     """
 
-    cursor = db.execute(query, params)
-    results = cursor.fetchall()
+    EXPLAINABLE = {"select", "with", "insert", "update", "delete", "replace"}
+
+    def __init__(self, threshold=SLOW_QUERY_THRESHOLD, size=SLOW_QUERY_LOG_SIZE, max_plans=128):
+        self.threshold = threshold
+        self.max_plans = max_plans
+        self._entries = deque(maxlen=size)
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _plan(self, conn, sql, normalized, parameters):
+        with self._lock:
+            plan = self._plans.get(normalized)
+            if plan is not None:
+                self._plans.move_to_end(normalized)
+                return plan
+        try:
+            rows = sqlite3.Connection.execute(conn, "EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+            # Indent each step under its parent, like the sqlite3 shell does
+            depths = {0: -1}
+            plan = []
+            for step_id, parent_id, _, detail in rows:
+                depths[step_id] = depths.get(parent_id, -1) + 1
+                plan.append("  " * depths[step_id] + detail)
+        except sqlite3.Error as e:
+            plan = [f"EXPLAIN failed: {str(e)}"]
+        with self._lock:
+            self._plans[normalized] = plan
+            while len(self._plans) > self.max_plans:
+                self._plans.popitem(last=False)
+        return plan
+
+    def record(self, conn, sql, parameters, elapsed, many=False):
+        normalized = normalize_sql(sql)
+        plan = None
+        # executemany parameters may be a consumed generator, so there's nothing to EXPLAIN with
+        if not many and sql_operation(sql) in self.EXPLAINABLE:
+            plan = self._plan(conn, sql, normalized, parameters)
+        entry = {
+            "sql": normalized,
+            "parameters": "many" if many else parameter_shape(parameters),
+            "duration_ms": round(elapsed * 1000, 3),
+            "plan": plan,
+            "at": datetime.now().isoformat(timespec="seconds"),
+            "endpoint": request.url_rule.rule if has_request_context() and request.url_rule is not None else None,
+        }
+        with self._lock:
+            self._entries.append(entry)
+        metrics.inc("dynotes_slow_queries_total")
+        app.logger.warning(f"Slow query ({entry['duration_ms']}ms): {normalized[:200]}")
 
-    return jsonify([dict(row) for row in results])
+    def entries(self):
+        with self._lock:
+            return list(self._entries)
 
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._plans.clear()
 
-@app.route("/update_mmr", methods=["POST"])
-def update_mmr():
-    db = get_db()
-    data = request.json
-    winner_id = data.get("winner_id")
-    loser_id = data.get("loser_id")
 
-    try:
-        cursor = db.cursor()
+slow_query_log = SlowQueryLog()
 
-        # Get current MMR values and match counts
-        cursor.execute("SELECT note_id, mmr, mmr_matches FROM Notes WHERE note_id IN (?, ?)", (winner_id, loser_id))
-        note_data = {row["note_id"]: row for row in cursor.fetchall()}
 
-        winner_data = note_data[winner_id]
-        loser_data = note_data[loser_id]
+def observe_query(conn, sql, parameters, elapsed, many=False):
+    metrics.observe("dynotes_sql_seconds", elapsed, op=sql_operation(sql))
+    if elapsed >= slow_query_log.threshold:
+        slow_query_log.record(conn, sql, parameters, elapsed, many)
 
-        # Calculate K-factor (higher for notes with fewer matches)
-        def calculate_k_factor(matches):
-            if matches < 10:
-                return 32
-            elif matches < 20:
-                return 24
-            else:
-                return 16
 
-        winner_k = calculate_k_factor(winner_data["mmr_matches"])
-        loser_k = calculate_k_factor(loser_data["mmr_matches"])
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that reports statement and fetch timings to the metrics registry."""
 
-        # Calculate expected scores
-        expected_winner = 1 / (1 + 10 ** ((loser_data["mmr"] - winner_data["mmr"]) / 400))
-        expected_loser = 1 - expected_winner
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            observe_query(self.connection, sql, parameters, time.perf_counter() - started)
 
-        # Calculate MMR changes
-        winner_change = int(winner_k * (1 - expected_winner))
-        loser_change = int(loser_k * (0 - expected_loser))
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            observe_query(self.connection, sql, None, time.perf_counter() - started, many=True)
 
-        # Ensure minimum change of 1
-        winner_change = max(1, winner_change)
-        loser_change = min(-1, loser_change)
+    def executescript(self, sql_script):
+        started = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            metrics.observe("dynotes_sql_seconds", time.perf_counter() - started, op="script")
 
-        # Update MMR values
-        cursor.execute("UPDATE Notes SET mmr = mmr + ?, mmr_matches = mmr_matches + 1 WHERE note_id = ?", (winner_change, winner_id))
-        cursor.execute("UPDATE Notes SET mmr = mmr + ?, mmr_matches = mmr_matches + 1 WHERE note_id = ?", (loser_change, loser_id))
+    def _timed_fetch(self, fetch, *args):
+        started = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            metrics.inc("dynotes_sql_fetch_seconds_total", time.perf_counter() - started)
 
-        db.commit()
-        return jsonify({"success": True, "winner_change": winner_change, "loser_change": loser_change, "winner_id": winner_id, "loser_id": loser_id})
-    except Exception as e:
-        db.rollback()
-        app.logger.error(f"Error in update_mmr: {str(e)}")
-        return jsonify({"success": False, "error": str(e)}), 500
+    def fetchone(self):
+        return self._timed_fetch(super().fetchone)
 
+    def fetchmany(self, size=None):
+        return self._timed_fetch(super().fetchmany, self.arraysize if size is None else size)
 
-@app.route("/delete_note", methods=["POST"])
-def delete_note():
-    db = get_db()
-    data = request.json
-    cursor = db.cursor()
+    def fetchall(self):
+        return self._timed_fetch(super().fetchall)
 
-    try:
-        # Delete the note
-        cursor.execute("DELETE FROM Notes WHERE note_id = ?", (data["noteId"],))
 
-        # Delete associated tag relationships
-        cursor.execute("DELETE FROM NoteTags WHERE note_id = ?", (data["noteId"],))
+class InstrumentedConnection(sqlite3.Connection):
+    # Connection.execute() doesn't go through Cursor.execute(), so route it explicitly
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
 
-        db.commit()
-        return jsonify({"success": True})
-    except Exception as e:
-        db.rollback()
-        app.logger.error(f"Error deleting note: {str(e)}")
-        return jsonify({"success": False, "error": str(e)}), 500
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
 
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
 
-# Optimized search function
-@app.route("/search", methods=["POST"])
-def search():
-    try:
-        db = get_db()
-        data = request.json
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
 
-        selected_tags = data.get("tags", [])
-        search_text = data.get("text", "")
-        password = data.get("password", "")
-        sort_criteria = data.get("sortCriteria", "stars-desc")
 
-        visibility_level = (
-            max([get_visibility_level(password, tag_id) for tag_id in selected_tags]) if selected_tags else get_visibility_level(password)
-        )
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
 
-        query = """
-        WITH RECURSIVE
-        tag_hierarchy(root_id, descendant_id) AS (
-            SELECT tag_id, tag_id FROM Tags WHERE tag_id IN ({})
-            UNION ALL
-            SELECT th.root_id, tr.child_tag_id
-            FROM tag_hierarchy th
-            JOIN TagRelationships tr ON th.descendant_id = tr.parent_tag_id
-        )
-        SELECT n.note_id, n.text, n.author, n.date, n.rating, n.source, n.visibility, n.mmr, n.mmr_matches,
-            GROUP_CONCAT(DISTINCT t.name) as tags
-        FROM Notes n
-        JOIN NoteTags nt ON n.note_id = nt.note_id
-        JOIN Tags t ON nt.tag_id = t.tag_id
-        WHERE n.visibility <= ?
-        AND (? = 0 OR n.note_id IN (
-            SELECT n.note_id
-            FROM Notes n
-            JOIN NoteTags nt ON n.note_id = nt.note_id
-            JOIN tag_hierarchy th ON nt.tag_id = th.descendant_id
-            GROUP BY n.note_id
-            HAVING COUNT(DISTINCT th.root_id) = ?
-        ))
-        """
 
-        params = [visibility_level, len(selected_tags), len(selected_tags)]
+@app.after_request
+def record_request_time(response):
+    started = g.pop("request_started", None)
+    if started is not None:
+        # Label by route pattern, not path, to keep the series count bounded
+        endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        metrics.observe("dynotes_request_seconds", time.perf_counter() - started, endpoint=endpoint, method=request.method, status=response.status_code)
+    return response
 
-        if selected_tags:
-            tag_placeholders = ",".join("?" for _ in selected_tags)
-            query = query.format(tag_placeholders)
-            params = selected_tags + params
-        else:
-            query = query.format("SELECT tag_id FROM Tags")
 
-        if search_text:
-            query += " AND n.text LIKE ?"
-            params.append(f"%{search_text}%")
+def runtime_gauges():
+    yield "dynotes_data_version", "Current data version (write generation)", get_data_version(get_read_db())
+    for name, value in get_write_queue().stats().items():
+        yield f"dynotes_write_queue_{name}", f"Write queue {name.replace('_', ' ')}", value
+    for name, value in search_cache.stats().items():
+        if name != "generation":
+            yield f"dynotes_search_cache_{name}", f"Search cache {name}", value
+    for name, value in tag_index.stats().items():
+        if name != "version":
+            yield f"dynotes_tag_index_{name}", f"Tag index {name.replace('_', ' ')}", value
 
-        query += " GROUP BY n.note_id"
 
-        sort_field, sort_order = sort_criteria.split("-")
-        sort_mapping = {"stars": "n.rating", "date": "n.date", "visibility": "n.visibility", "mmr": "n.mmr"}
-        query += f" ORDER BY {sort_mapping[sort_field]} {'DESC' if sort_order == 'desc' else 'ASC'}"
+@app.route("/admin/slow_queries", methods=["POST"])
+def slow_queries():
+    data = request.json or {}
+    # Same gate as /generate_tag_password: full visibility via password or token
+    if request_visibility_level({"token": data.get("token"), "password": data.get("admin_password", "")}) != 5:
+        return jsonify({"success": False, "error": "Invalid administrator password"}), 403
+    entries = slow_query_log.entries()
+    if data.get("clear"):
+        slow_query_log.clear()
+    return jsonify({"success": True, "threshold_ms": slow_query_log.threshold * 1000, "queries": entries[::-1]})
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return app.response_class(metrics.render(runtime_gauges()), mimetype="text/plain; version=0.0.4")
+
+
+def bitmap_from_ids(ids):
+    """Pack note ids into an int with bit n set for note n."""
+    ids = list(ids)
+    if not ids:
+        return 0
+    bits = bytearray(max(ids) // 8 + 1)
+    for note_id in ids:
+        bits[note_id >> 3] |= 1 << (note_id & 7)
+    return int.from_bytes(bits, "little")
+
+
+def bitmap_ids(bitmap):
+    """Unpack a bitmap into ascending note ids."""
+    bits = bin(bitmap)[:1:-1]
+    ids = []
+    position = bits.find("1")
+    while position != -1:
+        ids.append(position)
+        position = bits.find("1", position + 1)
+    return ids
+
+
+def bitmap_count(bitmap):
+    return bin(bitmap).count("1")
+
+
+class TagIndex:
+    """In-memory posting bitmaps answering "has a descendant of every selected tag".
+
+    Each tag maps to a bitmap (a Python int used as a bitset) of the notes
+    tagged with it directly. A selected tag expands to the union over its
+    descendants in TagClosure, cached per tag, and selected tags plus the
+    caller's visibility level combine by intersection, so SQLite only has to
+    fetch the surviving notes.
+
+    The index is tied to the membership version, which triggers bump only
+    for NoteTags, note visibility and TagClosure changes. The write queue
+    applies this process's changes to it while committing and then advances
+    its version; a version it didn't see (another process, a CLI rebuild)
+    makes the next reader rebuild it. Rebuilds run outside commit_lock, so
+    the writer keeps committing meanwhile.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.rebuilds = 0
+        self._postings = {}
+        self._visibility = {}
+        self._descendants = {}
+        self._ancestors = {}
+        self._expanded = {}
+        self._tagged = None
+        self._rebuild_lock = threading.Lock()
+
+    def sync(self, db):
+        """Make sure the index reflects at least the database's current membership version."""
+        version = get_membership_version(db)
+        # A newer index than the version just read is fine; only a stale one is rebuilt
+        while self._stale(version):
+            with self._rebuild_lock:
+                # Another reader may have rebuilt it while this one waited
+                if self._stale(version):
+                    self._rebuild(db)
+        return self
+
+    def _stale(self, version):
+        with commit_lock:
+            return self.version is None or self.version < version
+
+    def _rebuild(self, db):
+        # One read transaction so the postings and the version agree
+        db.execute("BEGIN")
+        try:
+            version = get_membership_version(db)
+            tag_notes = {}
+            for tag_id, note_id in db.execute("SELECT tag_id, note_id FROM NoteTags"):
+                tag_notes.setdefault(tag_id, []).append(note_id)
+            level_notes = {}
+            for note_id, visibility in db.execute("SELECT note_id, visibility FROM Notes"):
+                level_notes.setdefault(visibility, []).append(note_id)
+            descendants = {}
+            ancestors = {}
+            for ancestor_id, descendant_id in db.execute("SELECT ancestor_id, descendant_id FROM TagClosure"):
+                descendants.setdefault(ancestor_id, []).append(descendant_id)
+                ancestors.setdefault(descendant_id, []).append(ancestor_id)
+        finally:
+            db.execute("COMMIT")
+
+        postings = {tag_id: bitmap_from_ids(ids) for tag_id, ids in tag_notes.items()}
+        visibility = {level: bitmap_from_ids(ids) for level, ids in level_notes.items()}
+        with commit_lock:
+            # The writer may have moved a live index past this snapshot in the meantime
+            if self.version is not None and self.version >= version:
+                return
+            self._postings = postings
+            self._visibility = visibility
+            self._descendants = descendants
+            self._ancestors = ancestors
+            self._expanded = {}
+            self._tagged = None
+            self.version = version
+            self.rebuilds += 1
+
+    def invalidate(self):
+        with commit_lock:
+            self.version = None
+
+    def advance(self, before, after):
+        """Called by the writer after each commit, with its changes already applied.
+
+        before and after are the membership versions the write group started
+        from and committed; the index only stays live if it was at before.
+        """
+        with commit_lock:
+            if self.version is not None and self.version == before:
+                self.version = after
+            elif before != after:
+                self.version = None
+
+    def set_closure(self, closure):
+        """Replace the tag hierarchy with (ancestor_id, descendant_id) rows, after a tag graph edit."""
+        descendants = {}
+        ancestors = {}
+        for ancestor_id, descendant_id in closure:
+            descendants.setdefault(ancestor_id, []).append(descendant_id)
+            ancestors.setdefault(descendant_id, []).append(ancestor_id)
+        with commit_lock:
+            self._descendants = descendants
+            self._ancestors = ancestors
+            self._expanded = {}
+
+    def remove_tag(self, tag_id):
+        with commit_lock:
+            self._postings.pop(tag_id, None)
+            self._expanded = {}
+            self._tagged = None
+
+    def _touch(self, tag_ids):
+        # Drop cached unions that include these tags
+        for tag_id in tag_ids:
+            for ancestor_id in self._ancestors.get(tag_id, (tag_id,)):
+                self._expanded.pop(ancestor_id, None)
+        self._tagged = None
+
+    def add_note(self, note_id, visibility, tag_ids):
+        with commit_lock:
+            bit = 1 << note_id
+            self._visibility[visibility] = self._visibility.get(visibility, 0) | bit
+            for tag_id in tag_ids:
+                self._postings[tag_id] = self._postings.get(tag_id, 0) | bit
+            self._touch(tag_ids)
+
+    def remove_note(self, note_id, visibility, tag_ids):
+        with commit_lock:
+            mask = ~(1 << note_id)
+            if visibility in self._visibility:
+                self._visibility[visibility] &= mask
+            for tag_id in tag_ids:
+                if tag_id in self._postings:
+                    self._postings[tag_id] &= mask
+            self._touch(tag_ids)
+
+    def expanded(self, tag_id):
+        bitmap = self._expanded.get(tag_id)
+        if bitmap is None:
+            bitmap = 0
+            for descendant_id in self._descendants.get(tag_id, (tag_id,)):
+                bitmap |= self._postings.get(descendant_id, 0)
+            self._expanded[tag_id] = bitmap
+        return bitmap
+
+    def visible(self, visibility_level):
+        bitmap = 0
+        for level, notes in self._visibility.items():
+            if level is not None and level <= visibility_level:
+                bitmap |= notes
+        return bitmap
+
+    def matching(self, selected_tags, visibility_level):
+        """Bitmap of visible notes under every selected tag (any tag at all if none selected)."""
+        with commit_lock:
+            bitmap = self.visible(visibility_level)
+            if selected_tags:
+                # Narrowest tag first so the running intersection shrinks fastest
+                for tag_id in sorted(set(selected_tags), key=lambda tag_id: bitmap_count(self.expanded(tag_id))):
+                    bitmap &= self.expanded(tag_id)
+                    if not bitmap:
+                        break
+            else:
+                if self._tagged is None:
+                    tagged = 0
+                    for notes in self._postings.values():
+                        tagged |= notes
+                    self._tagged = tagged
+                bitmap &= self._tagged
+            return bitmap
+
+    def stats(self):
+        with commit_lock:
+            return {
+                "version": self.version,
+                "rebuilds": self.rebuilds,
+                "tags": len(self._postings),
+                "cached_unions": len(self._expanded),
+                "bytes": sum((bitmap.bit_length() + 7) // 8 for bitmap in self._postings.values()),
+            }
+
+
+tag_index = TagIndex()
+
+
+def connect_db(database, readonly=False, isolation_level=""):
+    """Open a SQLite connection with the app's PRAGMA tuning applied."""
+    if readonly:
+        # as_uri() percent-encodes the path, so a ?, # or % in it can't be read as URI syntax
+        uri = pathlib.Path(database).resolve().as_uri() + "?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=SQLITE_STATEMENT_CACHE, factory=InstrumentedConnection)
+    else:
+        conn = sqlite3.connect(database, check_same_thread=False, cached_statements=SQLITE_STATEMENT_CACHE, isolation_level=isolation_level, factory=InstrumentedConnection)
+        # WAL lets the read-only pool keep reading while a write is in progress
+        conn.execute("PRAGMA journal_mode = WAL")
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA cache_size = -{int(SQLITE_CACHE_SIZE_KB)}")
+    conn.execute(f"PRAGMA mmap_size = {int(SQLITE_MMAP_SIZE)}")
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.execute("PRAGMA busy_timeout = 5000")
+    return conn
+
+
+class ConnectionPool:
+    """Keeps tuned SQLite connections alive between requests.
+
+    Connections are checked out for the duration of a request and returned on
+    teardown, so the page cache and compiled statements survive. At most
+    max_idle connections are retained; extra ones are closed on release.
+    """
+
+    def __init__(self, database, readonly=False, max_idle=SQLITE_POOL_SIZE):
+        self.database = database
+        self.readonly = readonly
+        self._idle = queue.LifoQueue(maxsize=max_idle)
+
+    def _connect(self):
+        return connect_db(self.database, readonly=self.readonly)
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(readonly=False):
+    key = (DATABASE, readonly)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(DATABASE, readonly=readonly)
+        return _pools[key]
+
+
+def close_pools():
+    """Close and forget every pooled connection, e.g. before forking workers."""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close_all()
+
+
+def get_db():
+    if "db" not in g:
+        g.db = get_pool().acquire()
+    return g.db
+
+
+def get_read_db():
+    """Read-only connection for GET and search endpoints."""
+    if "read_db" not in g:
+        g.read_db = get_pool(readonly=True).acquire()
+    return g.read_db
+
+
+@app.teardown_appcontext
+def close_db(error):
+    db = g.pop("db", None)
+    if db is not None:
+        get_pool().release(db)
+    read_db = g.pop("read_db", None)
+    if read_db is not None:
+        get_pool(readonly=True).release(read_db)
+
+
+class WriteUnavailable(Exception):
+    """The write was not applied, or not yet; routes answer 503."""
+
+
+class WriteQueueFull(WriteUnavailable):
+    pass
+
+
+class WritePending(WriteUnavailable):
+    """Still queued when the submitter stopped waiting; it may yet commit."""
+
+
+# Held while a write group commits and its after-commit hooks run, so
+# in-memory indexes never lag behind the data version readers can see
+commit_lock = threading.RLock()
+
+
+class WriteQueue:
+    """Serializes all writes through one thread and connection.
+
+    Jobs are callables taking a cursor. The writer drains up to
+    WRITE_GROUP_COMMIT jobs at a time into a single BEGIN IMMEDIATE
+    transaction, wrapping each in a savepoint so one failing job doesn't
+    undo the others, and commits once for the whole group.
+    """
+
+    def __init__(self, database, max_depth=WRITE_QUEUE_DEPTH, group_size=WRITE_GROUP_COMMIT):
+        self.database = database
+        self.group_size = group_size
+        self._queue = queue.Queue(maxsize=max_depth)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._job_hooks = None
+        self.counters = {"submitted": 0, "completed": 0, "failed": 0, "rejected": 0, "timed_out": 0, "commits": 0, "restarts": 0, "max_depth": 0, "wait_seconds": 0.0}
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def _ensure_started(self):
+        # Also the supervisor: a writer that died is replaced by the next caller
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                if self._thread is not None:
+                    self.counters["restarts"] += 1
+                    app.logger.error("Writer thread died, starting a new one.")
+                self._thread = threading.Thread(target=self._run, name="dynotes-writer", daemon=True)
+                self._thread.start()
+
+    def submit(self, fn, *args, timeout=WRITE_TIMEOUT):
+        """Run fn(cursor, *args) on the writer and return its result (or raise its error)."""
+        self._ensure_started()
+        job = (fn, args, Future(), time.monotonic())
+        try:
+            self._queue.put(job, timeout=WRITE_ENQUEUE_TIMEOUT)
+        except queue.Full:
+            self._count("rejected")
+            raise WriteQueueFull("Too many pending writes, try again shortly")
+        with self._lock:
+            self.counters["submitted"] += 1
+            self.counters["max_depth"] = max(self.counters["max_depth"], self._queue.qsize())
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return job[2].result(timeout=min(1.0, max(0.0, deadline - time.monotonic())))
+            except FutureTimeout:
+                if time.monotonic() >= deadline:
+                    self._count("timed_out")
+                    raise WritePending("Write still pending and may yet be applied; check before retrying")
+                self._ensure_started()
+
+    def after_commit(self, fn, *args):
+        """From inside a job, run fn(*args) once the job's group has committed.
+
+        Dropped if the job fails. Outside the writer (e.g. a CLI command calling
+        a job function directly) this does nothing.
+        """
+        if self._job_hooks is not None and threading.current_thread() is self._thread:
+            self._job_hooks.append((fn, args))
+
+    def drain(self, timeout=WRITE_TIMEOUT):
+        """Wait until every queued write has committed; False if some were still pending at timeout."""
+        deadline = time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        stats["depth"] = self._queue.qsize()
+        stats["capacity"] = self._queue.maxsize
+        return stats
+
+    def _run(self):
+        conn = connect_db(self.database, isolation_level=None)
+        while True:
+            jobs = [self._queue.get()]
+            while len(jobs) < self.group_size:
+                try:
+                    jobs.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._run_group(conn, jobs)
+            except BaseException as e:
+                # Don't leave submitters waiting on jobs that went down with the thread
+                for _, _, future, _ in jobs:
+                    if not future.done():
+                        future.set_exception(e)
+                conn.close()
+                raise
+            finally:
+                for _ in jobs:
+                    self._queue.task_done()
+
+    def _run_group(self, conn, jobs):
+        cursor = conn.cursor()
+        outcomes = []
+        hooks = []
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            membership = get_membership_version(conn)
+            for fn, args, _, _ in jobs:
+                cursor.execute("SAVEPOINT job")
+                self._job_hooks = []
+                try:
+                    outcomes.append((True, fn(cursor, *args)))
+                    cursor.execute("RELEASE job")
+                    hooks.extend(self._job_hooks)
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO job")
+                    cursor.execute("RELEASE job")
+                    outcomes.append((False, e))
+                finally:
+                    self._job_hooks = None
+            committed_membership = membership
+            if any(ok for ok, _ in outcomes):
+                bump_data_version(cursor)
+                committed_membership = get_membership_version(conn)
+            with commit_lock:
+                cursor.execute("COMMIT")
+                for hook, hook_args in hooks:
+                    try:
+                        hook(*hook_args)
+                    except Exception as e:
+                        app.logger.error(f"After-commit hook failed: {str(e)}")
+                        tag_index.invalidate()
+                tag_index.advance(membership, committed_membership)
+            self._count("commits")
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            app.logger.error(f"Write group failed: {str(e)}")
+            outcomes = [(False, e)] * len(jobs)
+
+        now = time.monotonic()
+        for (_, _, future, queued_at), (ok, value) in zip(jobs, outcomes):
+            self._count("wait_seconds", now - queued_at)
+            if ok:
+                self._count("completed")
+                future.set_result(value)
+            else:
+                self._count("failed")
+                future.set_exception(value)
+
+
+_write_queues = {}
+
+
+def get_write_queue():
+    with _pools_lock:
+        if DATABASE not in _write_queues:
+            _write_queues[DATABASE] = WriteQueue(DATABASE)
+        return _write_queues[DATABASE]
+
+
+@app.route("/write_queue_stats", methods=["GET"])
+def write_queue_stats():
+    return jsonify(get_write_queue().stats())
+
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+
+def load_migrations(directory=MIGRATIONS_DIR):
+    """Return [(version, name, sql)] for NNNN_name.sql files, in version order."""
+    migrations = []
+    for filename in sorted(os.listdir(directory)):
+        match = re.match(r"^(\d+)_(\w+)\.sql$", filename)
+        if match:
+            with open(os.path.join(directory, filename)) as f:
+                migrations.append((int(match.group(1)), match.group(2), f.read()))
+    migrations.sort()
+    for expected, (version, name, _) in enumerate(migrations, start=1):
+        if version != expected:
+            raise RuntimeError(f"Migration {version}_{name} is out of sequence, expected version {expected}")
+    return migrations
+
+
+def get_schema_version(db):
+    return db.execute("PRAGMA user_version").fetchone()[0]
+
+
+def apply_migrations(db, migrations=None):
+    """Apply every migration newer than PRAGMA user_version, then ANALYZE.
+
+    Each migration runs in its own transaction together with the
+    user_version bump, so a failed one leaves the database at the previous
+    version. Returns the names of the migrations applied.
+    """
+    if migrations is None:
+        migrations = load_migrations()
+    current = get_schema_version(db)
+    applied = []
+    for version, name, sql in migrations:
+        if version <= current:
+            continue
+        try:
+            db.executescript(f"BEGIN;\n{sql}\nPRAGMA user_version = {version};\nCOMMIT;")
+        except sqlite3.Error:
+            if db.in_transaction:
+                db.rollback()
+            raise
+        applied.append(f"{version:04d}_{name}")
+    if applied:
+        # Refresh planner statistics so the new indexes actually get picked
+        db.execute("ANALYZE")
+        db.commit()
+    return applied
+
+
+def init_db():
+    with app.app_context():
+        db = get_db()
+        if get_schema_version(db) == 0:
+            # schema.sql is the baseline for migrations; every statement is IF NOT EXISTS,
+            # so on databases that predate migrations it only adds what's missing
+            existing = {row["name"] for row in db.execute("SELECT name FROM sqlite_master")}
+            with app.open_resource("schema.sql", mode="r") as f:
+                db.cursor().executescript(f.read())
+            if existing and "NotesFTS" not in existing:
+                db.execute("INSERT INTO NotesFTS(NotesFTS) VALUES ('rebuild')")
+                app.logger.info("Built full-text index for existing notes.")
+            if existing and "TagClosure" not in existing:
+                rebuild_tag_closure(db.cursor())
+                app.logger.info("Built tag closure for existing tags.")
+            if existing and "StatCounters" not in existing:
+                rebuild_stats(db.cursor())
+                app.logger.info("Built stat counters for existing data.")
+            db.commit()
+
+        applied = apply_migrations(db)
+        for name in applied:
+            app.logger.info(f"Applied migration {name}.")
+        if applied:
+            # The schema may have changed derived data, so invalidate cached responses
+            bump_data_version(db.cursor())
+            db.commit()
+        app.logger.info(f"Database at schema version {get_schema_version(db)}.")
+
+
+@app.cli.command("migrate")
+def migrate_command():
+    """Bring the database schema up to date."""
+    db = get_db()
+    before = get_schema_version(db)
+    init_db()
+    after = get_schema_version(db)
+    if after == before:
+        print(f"Already at schema version {after}.")
+    else:
+        print(f"Migrated schema from version {before} to {after}.")
+
+
+def fts_terms(search_text):
+    # Lowercased so equivalent queries share a search cache entry; the tokenizer folds case anyway
+    return re.findall(r"\w+", search_text.lower())
 
-        cursor = db.execute(query, params)
-        results = cursor.fetchall()
 
-        return jsonify([dict(row) for row in results])
+def build_fts_query(search_text):
+    """Turn free text into an FTS5 MATCH expression of quoted prefix terms.
+
+    Returns None if the text has no indexable tokens.
+    """
+    terms = fts_terms(search_text)
+    if not terms:
+        return None
+    return " ".join('"{}"*'.format(term.replace('"', '""')) for term in terms)
+
+
+# Ranking every hit is only worth it when sorting by relevance; otherwise the
+# rank is filled in with the snippets, for the rows actually returned. Before
+# SQLite 3.35 the CTE can't be pinned and the planner may inline the MATCH
+FTS_HITS_CTE = f"""
+        fts_hits(note_id) {CTE_MATERIALIZED} (
+            SELECT rowid FROM NotesFTS WHERE NotesFTS MATCH ?
+        )"""
+FTS_RANKED_HITS_CTE = f"""
+        fts_hits(note_id, rank) {CTE_MATERIALIZED} (
+            SELECT rowid, bm25(NotesFTS) FROM NotesFTS WHERE NotesFTS MATCH ?
+        )"""
+FTS_SNIPPET = "snippet(NotesFTS, 0, '<mark>', '</mark>', '…', 16)"
+
+
+@app.route("/")
+def index():
+    return render_template("index.html")
+
+
+def _edit_note(cursor, data):
+    # Fetch the current note data
+    cursor.execute("SELECT * FROM Notes WHERE note_id = ?", (data["noteId"],))
+    current_note = cursor.fetchone()
+
+    if not current_note:
+        raise Exception("Note not found")
+
+    # Prepare the update fields
+    update_fields = []
+    update_values = []
+    for field in ["text", "author", "rating", "source", "visibility"]:
+        if field in data:
+            update_fields.append(f"{field} = ?")
+            update_values.append(data[field])
+
+    # Only proceed with update if there are fields to update
+    if update_fields:
+        # Construct and execute the update query
+        update_query = f"""
+        UPDATE Notes
+        SET {', '.join(update_fields)}
+        WHERE note_id = ?
+        """
+        update_values.append(data["noteId"])
+        cursor.execute(update_query, update_values)
+
+    if "tags" in data or "visibility" in data:
+        cursor.execute("SELECT tag_id FROM NoteTags WHERE note_id = ?", (data["noteId"],))
+        old_tags = [row["tag_id"] for row in cursor.fetchall()]
+        new_tags = data.get("tags", old_tags)
+        write_queue = get_write_queue()
+        write_queue.after_commit(tag_index.remove_note, data["noteId"], current_note["visibility"], old_tags)
+        write_queue.after_commit(tag_index.add_note, data["noteId"], data.get("visibility", current_note["visibility"]), new_tags)
+
+    # Update tags only if they're provided
+    if "tags" in data:
+        # Delete existing tag associations
+        cursor.execute("DELETE FROM NoteTags WHERE note_id = ?", (data["noteId"],))
+
+        # Add new tag associations
+        cursor.executemany("INSERT INTO NoteTags (note_id, tag_id) VALUES (?, ?)", [(data["noteId"], tag_id) for tag_id in data["tags"]])
+        refresh_tag_names(cursor, [data["noteId"]])
+
+    log_note_changes(cursor, [data["noteId"]])
+
+
+@app.route("/edit_note", methods=["POST"])
+def edit_note():
+    data = request.json
+
+    try:
+        get_write_queue().submit(_edit_note, data)
+        mmr_sampler.invalidate()
+        return jsonify({"success": True})
+    except WriteUnavailable as e:
+        return jsonify({"success": False, "error": str(e)}), 503
     except Exception as e:
-        app.logger.error(f"Error in search: {str(e)}", exc_info=True)
-        return jsonify({"error": str(e)}), 500
+        app.logger.error(f"Error editing note: {str(e)}")
+        return jsonify({"success": False, "error": str(e)}), 500
 
 
-@app.route("/search2", methods=["POST"])
-def search2():
+class MMRSampler:
+    """Draws comparison pairs from cached arrays of eligible note ids.
+
+    Eligible ids are loaded once per (tag filter, visibility level) and kept
+    until a write invalidates them, so a draw is O(1) and only the two chosen
+    notes are read in full. Ratings are tracked alongside so pairing can
+    favour evenly matched, under-compared notes.
+    """
+
+    CANDIDATES = 8  # notes inspected per draw when pairing informatively
+
+    def __init__(self, max_entries=64, ttl=MMR_SAMPLER_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._ratings = {}
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self._ratings.clear()
+
+    def apply_result(self, note_id, mmr_change):
+        with self._lock:
+            rating = self._ratings.get(note_id)
+            if rating is not None:
+                rating[0] += mmr_change
+                rating[1] += 1
+
+    def eligible_ids(self, db, selected_tags, visibility_level):
+        key = (tuple(sorted(selected_tags)), visibility_level)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                return entry[0]
+
+        query = "SELECT n.note_id, n.mmr, n.mmr_matches FROM Notes n WHERE n.visibility <= ?"
+        params = [visibility_level]
+        if selected_tags:
+            query += " AND n.note_id IN (SELECT value FROM json_each(?))"
+            params.append(json.dumps(bitmap_ids(tag_index.sync(db).matching(selected_tags, visibility_level))))
+        rows = db.execute(query, params).fetchall()
+        ids = [row["note_id"] for row in rows]
+
+        with self._lock:
+            # Fresh rows win: other workers' votes and reset_mmr.py only show up here
+            for row in rows:
+                self._ratings[row["note_id"]] = [row["mmr"], row["mmr_matches"]]
+            self._entries[key] = (ids, time.monotonic() + self.ttl)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return ids
+
+    def draw_pair(self, ids, informative=False):
+        if len(ids) < 2:
+            return tuple(ids)
+        if not informative:
+            return tuple(random.sample(ids, 2))
+
+        with self._lock:
+            ratings = {note_id: self._ratings.get(note_id, [1500, 0]) for note_id in random.sample(ids, min(len(ids), self.CANDIDATES * 2))}
+        candidates = list(ratings)
+        # Least-compared note first, then the opponent closest to it in rating
+        first = min(candidates[: self.CANDIDATES], key=lambda note_id: ratings[note_id][1])
+        rest = [note_id for note_id in candidates if note_id != first]
+        second = min(rest, key=lambda note_id: abs(ratings[note_id][0] - ratings[first][0]) + 10 * ratings[note_id][1])
+        return first, second
+
+    def draw_pairs(self, ids, count, informative=False):
+        """Draw up to count distinct unordered pairs."""
+        max_pairs = len(ids) * (len(ids) - 1) // 2
+        pairs = []
+        seen = set()
+        for _ in range(count * 4):
+            if len(pairs) >= min(count, max_pairs):
+                break
+            pair = self.draw_pair(ids, informative)
+            if frozenset(pair) not in seen:
+                seen.add(frozenset(pair))
+                pairs.append(pair)
+        return pairs
+
+
+mmr_sampler = MMRSampler()
+
+
+@app.route("/get_mmr_notes", methods=["POST"])
+def get_mmr_notes():
+    db = get_read_db()
+    data = request.json
+    selected_tags = data.get("tags", [])
+    informative = data.get("pairing") == "informative"
+
+    # visibility_level = 5 if check_password_hash(PASSWORD_HASH, password) else 1
+    visibility_level = request_visibility_level(data)
+    if visibility_level is None:
+        return jsonify({"error": "Invalid or expired token"}), 401
+
+    query = """
+    SELECT n.note_id, n.text, n.author, n.date, n.rating, n.source, n.visibility, n.mmr, n.mmr_matches,
+           n.tag_names AS tags
+    FROM Notes n
+    WHERE n.note_id IN (?, ?)
+    """
+
+    # A note may have been deleted by another worker since the ids were cached
+    for _ in range(2):
+        pair = mmr_sampler.draw_pair(mmr_sampler.eligible_ids(db, selected_tags, visibility_level), informative)
+        if not pair:
+            return jsonify([])
+        rows = {row["note_id"]: dict(row) for row in db.execute(query, (pair * 2)[:2]).fetchall()}
+        if len(rows) == len(pair):
+            return jsonify([rows[note_id] for note_id in pair])
+        mmr_sampler.invalidate()
+
+    return jsonify([])
+
+
+def calculate_k_factor(matches):
+    """K-factor for a note, higher for notes with fewer matches."""
+    if matches < 10:
+        return 32
+    elif matches < 20:
+        return 24
+    else:
+        return 16
+
+
+def calculate_mmr_changes(winner_mmr, winner_matches, loser_mmr, loser_matches):
+    """Elo update for a single vote. Returns (winner_change, loser_change)."""
+    winner_k = calculate_k_factor(winner_matches)
+    loser_k = calculate_k_factor(loser_matches)
+
+    # Calculate expected scores
+    expected_winner = 1 / (1 + 10 ** ((loser_mmr - winner_mmr) / 400))
+    expected_loser = 1 - expected_winner
+
+    # Calculate MMR changes
+    winner_change = int(winner_k * (1 - expected_winner))
+    loser_change = int(loser_k * (0 - expected_loser))
+
+    # Ensure minimum change of 1
+    return max(1, winner_change), min(-1, loser_change)
+
+
+def _update_mmr(cursor, winner_id, loser_id):
+    # Get current MMR values and match counts; the writer holds the write lock,
+    # so nothing can change them between this read and the update below
+    cursor.execute("SELECT note_id, mmr, mmr_matches FROM Notes WHERE note_id IN (?, ?)", (winner_id, loser_id))
+    note_data = {row["note_id"]: row for row in cursor.fetchall()}
+
+    winner_data = note_data[winner_id]
+    loser_data = note_data[loser_id]
+
+    winner_change, loser_change = calculate_mmr_changes(winner_data["mmr"], winner_data["mmr_matches"], loser_data["mmr"], loser_data["mmr_matches"])
+
+    # Update MMR values
+    cursor.execute("UPDATE Notes SET mmr = mmr + ?, mmr_matches = mmr_matches + 1 WHERE note_id = ?", (winner_change, winner_id))
+    cursor.execute("UPDATE Notes SET mmr = mmr + ?, mmr_matches = mmr_matches + 1 WHERE note_id = ?", (loser_change, loser_id))
+    log_note_changes(cursor, [winner_id, loser_id])
+
+    # Keep the raw result so ratings can be replayed later
+    cursor.execute("INSERT INTO Comparisons (winner_id, loser_id, date) VALUES (?, ?, ?)", (winner_id, loser_id, int(time.time())))
+    return winner_change, loser_change
+
+
+@app.route("/update_mmr", methods=["POST"])
+def update_mmr():
+    data = request.json
+    winner_id = data.get("winner_id")
+    loser_id = data.get("loser_id")
+
     try:
-        db = get_db()
-        data = request.json
+        winner_change, loser_change = get_write_queue().submit(_update_mmr, winner_id, loser_id)
+        mmr_sampler.apply_result(winner_id, winner_change)
+        mmr_sampler.apply_result(loser_id, loser_change)
+        return jsonify({"success": True, "winner_change": winner_change, "loser_change": loser_change, "winner_id": winner_id, "loser_id": loser_id})
+    except WriteUnavailable as e:
+        return jsonify({"success": False, "error": str(e)}), 503
+    except Exception as e:
+        app.logger.error(f"Error in update_mmr: {str(e)}")
+        return jsonify({"success": False, "error": str(e)}), 500
 
-        app.logger.debug(f"Search request data: {data}")
-        selected_tags = data.get("tags", [])
-        search_text = data.get("text", "")
-        password = data.get("password", "")
-        sort_criteria = data.get("sortCriteria", "stars-desc")
 
-        # Check visibility level for each selected tag
-        visibility_levels = [get_visibility_level(password, tag_id) for tag_id in selected_tags]
-        visibility_level = max(visibility_levels) if visibility_levels else get_visibility_level(password)
+MAX_MMR_BATCH = 50
 
-        query = """
-        WITH RECURSIVE
-        tag_hierarchy(root_id, descendant_id) AS (
-            SELECT tag_id, tag_id FROM Tags WHERE tag_id IN ({})
-            UNION
-            SELECT th.root_id, tr.child_tag_id
-            FROM tag_hierarchy th
-            JOIN TagRelationships tr ON th.descendant_id = tr.parent_tag_id
-        ),
-        matching_notes AS (
-            SELECT n.note_id
-            FROM Notes n
-            JOIN NoteTags nt ON n.note_id = nt.note_id
-            JOIN tag_hierarchy th ON nt.tag_id = th.descendant_id
-            GROUP BY n.note_id
-            HAVING COUNT(DISTINCT th.root_id) = ?
+
+@app.route("/get_mmr_batch", methods=["POST"])
+def get_mmr_batch():
+    db = get_read_db()
+    data = request.json
+    selected_tags = data.get("tags", [])
+    informative = data.get("pairing") == "informative"
+    try:
+        count = max(1, min(int(data.get("count", 10)), MAX_MMR_BATCH))
+    except (TypeError, ValueError):
+        return jsonify({"error": "count must be an integer"}), 400
+
+    visibility_level = request_visibility_level(data)
+    if visibility_level is None:
+        return jsonify({"error": "Invalid or expired token"}), 401
+
+    pairs = mmr_sampler.draw_pairs(mmr_sampler.eligible_ids(db, selected_tags, visibility_level), count, informative)
+    note_ids = list({note_id for pair in pairs for note_id in pair})
+    if not note_ids:
+        return jsonify([])
+
+    placeholders = ",".join("?" for _ in note_ids)
+    query = f"""
+    SELECT n.note_id, n.text, n.author, n.date, n.rating, n.source, n.visibility, n.mmr, n.mmr_matches,
+           n.tag_names AS tags
+    FROM Notes n
+    WHERE n.note_id IN ({placeholders})
+    """
+    rows = {row["note_id"]: dict(row) for row in db.execute(query, note_ids).fetchall()}
+    if len(rows) < len(note_ids):
+        # Some cached ids are gone; serve what's left and reload next time
+        mmr_sampler.invalidate()
+
+    return jsonify([[rows[first], rows[second]] for first, second in pairs if first in rows and second in rows])
+
+
+def _update_mmr_batch(cursor, results):
+    note_ids = list({note_id for result in results for note_id in (result["winner_id"], result["loser_id"])})
+    placeholders = ",".join("?" for _ in note_ids)
+    cursor.execute(f"SELECT note_id, mmr, mmr_matches FROM Notes WHERE note_id IN ({placeholders})", note_ids)
+    ratings = {row["note_id"]: [row["mmr"], row["mmr_matches"]] for row in cursor.fetchall()}
+
+    # Apply votes in order so each one sees the ratings left by the previous
+    applied = []
+    for result in results:
+        winner = ratings[result["winner_id"]]
+        loser = ratings[result["loser_id"]]
+        winner_change, loser_change = calculate_mmr_changes(winner[0], winner[1], loser[0], loser[1])
+        winner[0] += winner_change
+        winner[1] += 1
+        loser[0] += loser_change
+        loser[1] += 1
+        applied.append(
+            {
+                "winner_id": result["winner_id"],
+                "loser_id": result["loser_id"],
+                "winner_change": winner_change,
+                "loser_change": loser_change,
+                "winner_mmr": winner[0],
+                "loser_mmr": loser[0],
+            }
         )
-        SELECT n.note_id, n.text, n.author, n.date, n.rating, n.source, n.visibility, n.mmr, n.mmr_matches,
-            GROUP_CONCAT(DISTINCT t.name) as tags
-        FROM Notes n
-        JOIN matching_notes mn ON n.note_id = mn.note_id
-        JOIN NoteTags nt ON n.note_id = nt.note_id
-        JOIN Tags t ON nt.tag_id = t.tag_id
-        WHERE n.visibility <= ?
+
+    cursor.executemany("UPDATE Notes SET mmr = ?, mmr_matches = ? WHERE note_id = ?", [(mmr, matches, note_id) for note_id, (mmr, matches) in ratings.items()])
+    log_note_changes(cursor, ratings)
+    now = int(time.time())
+    cursor.executemany("INSERT INTO Comparisons (winner_id, loser_id, date) VALUES (?, ?, ?)", [(result["winner_id"], result["loser_id"], now) for result in applied])
+    return applied
+
+
+@app.route("/update_mmr_batch", methods=["POST"])
+def update_mmr_batch():
+    data = request.json
+    results = data.get("results", [])
+
+    if not isinstance(results, list):
+        return jsonify({"success": False, "error": "results must be a list"}), 400
+    if len(results) > MAX_MMR_BATCH:
+        return jsonify({"success": False, "error": f"At most {MAX_MMR_BATCH} results per batch"}), 400
+    # Checked up front, so a KeyError from the job below can only mean a missing note
+    for index, result in enumerate(results):
+        if not isinstance(result, dict) or not all(isinstance(result.get(key), int) and not isinstance(result.get(key), bool) for key in ("winner_id", "loser_id")):
+            return jsonify({"success": False, "error": f"results[{index}] must have integer winner_id and loser_id"}), 400
+
+    try:
+        applied = get_write_queue().submit(_update_mmr_batch, results)
+        for result in applied:
+            mmr_sampler.apply_result(result["winner_id"], result["winner_change"])
+            mmr_sampler.apply_result(result["loser_id"], result["loser_change"])
+        return jsonify({"success": True, "results": applied})
+    except KeyError as e:
+        return jsonify({"success": False, "error": f"Unknown note id {e}"}), 400
+    except WriteUnavailable as e:
+        return jsonify({"success": False, "error": str(e)}), 503
+    except Exception as e:
+        app.logger.error(f"Error in update_mmr_batch: {str(e)}")
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
+def _delete_note(cursor, note_id):
+    cursor.execute("SELECT visibility FROM Notes WHERE note_id = ?", (note_id,))
+    note = cursor.fetchone()
+    if note is not None:
+        cursor.execute("SELECT tag_id FROM NoteTags WHERE note_id = ?", (note_id,))
+        tag_ids = [row["tag_id"] for row in cursor.fetchall()]
+        get_write_queue().after_commit(tag_index.remove_note, note_id, note["visibility"], tag_ids)
+
+    # Delete associated tag relationships
+    cursor.execute("DELETE FROM NoteTags WHERE note_id = ?", (note_id,))
+
+    # Delete the note
+    cursor.execute("DELETE FROM Notes WHERE note_id = ?", (note_id,))
+    if note is not None:
+        log_change(cursor, "note", note_id, "delete")
+
+
+@app.route("/delete_note", methods=["POST"])
+def delete_note():
+    data = request.json
+
+    try:
+        get_write_queue().submit(_delete_note, data["noteId"])
+        mmr_sampler.invalidate()
+        return jsonify({"success": True})
+    except WriteUnavailable as e:
+        return jsonify({"success": False, "error": str(e)}), 503
+    except Exception as e:
+        app.logger.error(f"Error deleting note: {str(e)}")
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
+# Columns of a note upsert in the change log, matching a /search result row
+NOTE_CHANGE_DATA = """json_object(
+    'note_id', note_id, 'text', text, 'author', author, 'date', date, 'rating', rating, 'source', source,
+    'visibility', visibility, 'mmr', mmr, 'mmr_matches', mmr_matches, 'tags', tag_names)"""
+
+# Wakes /changes/stream readers in this process as soon as a logged change commits
+changes_condition = threading.Condition()
+_changes_since_compaction = 0
+
+
+def notify_changes():
+    with changes_condition:
+        changes_condition.notify_all()
+
+
+def _changes_logged(cursor, count):
+    # Only the writer thread (or a CLI command) gets here, so the counter needs no lock
+    global _changes_since_compaction
+    _changes_since_compaction += count
+    if _changes_since_compaction >= CHANGE_LOG_COMPACT_EVERY:
+        _changes_since_compaction = 0
+        compact_change_log(cursor)
+    get_write_queue().after_commit(notify_changes)
+
+
+def log_change(cursor, entity, entity_id, op, data=None):
+    cursor.execute(
+        "INSERT INTO ChangeLog (created_at, entity, entity_id, op, data) VALUES (?, ?, ?, ?, ?)",
+        (int(time.time()), entity, str(entity_id), op, None if data is None else json.dumps(data)),
+    )
+    _changes_logged(cursor, 1)
+
+
+def log_tag_change(cursor, tag_id):
+    cursor.execute(
         """
+        INSERT INTO ChangeLog (created_at, entity, entity_id, op, data)
+        SELECT ?, 'tag', tag_id, 'upsert', json_object('tag_id', tag_id, 'name', name, 'readable_id', readable_id)
+        FROM Tags WHERE tag_id = ?
+    """,
+        (int(time.time()), tag_id),
+    )
+    _changes_logged(cursor, cursor.rowcount)
 
-        params = []
+
+def log_note_changes(cursor, note_ids=None, tag_id=None):
+    """Log an upsert with the current row of each note in note_ids, or of every note carrying tag_id."""
+    query = f"""
+    INSERT INTO ChangeLog (created_at, entity, entity_id, op, visibility, data)
+    SELECT ?, 'note', note_id, 'upsert', visibility, {NOTE_CHANGE_DATA}
+    FROM Notes"""
+    if tag_id is not None:
+        query += " WHERE note_id IN (SELECT note_id FROM NoteTags WHERE tag_id = ?)"
+        params = (int(time.time()), tag_id)
+    else:
+        note_ids = list(note_ids)
+        if not note_ids:
+            return
+        query += " WHERE note_id IN (SELECT value FROM json_each(?))"
+        params = (int(time.time()), json.dumps(note_ids))
+    cursor.execute(query, params)
+    _changes_logged(cursor, cursor.rowcount)
+
+
+def compact_change_log(cursor, retention=CHANGE_LOG_RETENTION):
+    """Drop entries superseded by a newer one for the same entity, then all but the newest retention.
+
+    Superseded entries can go without anyone noticing, since every entry
+    carries the entity's whole state. Trimming to retention raises
+    change_log_floor; clients still behind it have to reload. Returns the
+    number of entries removed.
+    """
+    cursor.execute(
+        """
+        DELETE FROM ChangeLog
+        WHERE seq < (SELECT MAX(c.seq) FROM ChangeLog c WHERE c.entity = ChangeLog.entity AND c.entity_id = ChangeLog.entity_id)
+    """
+    )
+    removed = cursor.rowcount
+    cursor.execute("SELECT seq FROM ChangeLog ORDER BY seq DESC LIMIT 1 OFFSET ?", (retention,))
+    row = cursor.fetchone()
+    if row is not None:
+        cursor.execute("DELETE FROM ChangeLog WHERE seq <= ?", (row[0],))
+        removed += cursor.rowcount
+        cursor.execute("UPDATE StatCounters SET value = MAX(value, ?) WHERE name = 'change_log_floor'", (row[0],))
+    return removed
+
+
+def read_changes(db, since, visibility_level, limit=CHANGES_PAGE_SIZE):
+    """Entries after since, oldest first, with notes above visibility_level turned into deletes.
+
+    Returns {"changes", "next", "has_more", "reset"}; reset means since is
+    older than the retained log (or newer than any entry) and the client has
+    to reload before resuming from next. Without since, only next is filled in.
+    """
+    # One read transaction so the head, the floor and the entries agree
+    db.execute("BEGIN")
+    try:
+        row = db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'ChangeLog'").fetchone()
+        head = row[0] if row else 0
+        floor = db.execute("SELECT value FROM StatCounters WHERE name = 'change_log_floor'").fetchone()[0]
+        if since is None:
+            return {"changes": [], "next": head, "has_more": False, "reset": False}
+        if since < floor or since > head:
+            return {"changes": [], "next": head, "has_more": False, "reset": True}
+        rows = db.execute(
+            """
+            SELECT seq, created_at, entity, entity_id,
+                   CASE WHEN visibility > ? THEN 'delete' ELSE op END AS op,
+                   CASE WHEN visibility > ? THEN NULL ELSE data END AS data
+            FROM ChangeLog
+            WHERE seq > ? AND seq <= ?
+            ORDER BY seq
+            LIMIT ?
+        """,
+            (visibility_level, visibility_level, since, head, limit + 1),
+        ).fetchall()
+    finally:
+        db.execute("COMMIT")
+
+    has_more = len(rows) > limit
+    changes = [
+        {
+            "seq": row["seq"],
+            "at": row["created_at"],
+            "entity": row["entity"],
+            "id": int(row["entity_id"]) if row["entity"] != "relationship" else row["entity_id"],
+            "op": row["op"],
+            "data": json.loads(row["data"]) if row["data"] is not None else None,
+        }
+        for row in rows[:limit]
+    ]
+    return {"changes": changes, "next": changes[-1]["seq"] if has_more else head, "has_more": has_more, "reset": False}
+
+
+@app.route("/changes", methods=["GET"])
+def get_changes():
+    """Tag, relationship and note changes after ?since=<seq>, for clients applying deltas.
+
+    Upserts carry the entity's whole new state, deletes just its id. Take
+    next without since before the initial /graph and search loads, then
+    poll with since=next. A 410 with reset: true means the log no longer
+    reaches back that far: reload and resume from next.
+    """
+    if "password" in request.args:
+        return jsonify({"error": PASSWORD_IN_QUERY_ERROR}), 400
+    visibility_level = query_visibility_level()
+    if visibility_level is None:
+        return jsonify({"error": "Invalid or expired token"}), 401
+    since = request.args.get("since", type=int)
+    limit = max(1, min(request.args.get("limit", CHANGES_PAGE_SIZE, type=int), CHANGES_PAGE_SIZE))
+
+    try:
+        feed = read_changes(get_read_db(), since, visibility_level, limit)
+        if feed["reset"]:
+            return jsonify({"success": False, "error": "Change log no longer covers since, reload", **feed}), 410
+        return jsonify(feed)
+    except Exception as e:
+        app.logger.error(f"Error reading changes: {str(e)}")
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
+@app.route("/changes/stream", methods=["GET"])
+def stream_changes():
+    """Server-Sent Events variant of /changes: one "change" event per entry, its seq as the event id.
+
+    Resumes from Last-Event-ID when the browser reconnects. Sends a "reset"
+    event and ends the stream when the client is behind the retained log.
+    """
+    if "password" in request.args:
+        return jsonify({"error": PASSWORD_IN_QUERY_ERROR}), 400
+    visibility_level = query_visibility_level()
+    if visibility_level is None:
+        return jsonify({"error": "Invalid or expired token"}), 401
+    since = request.headers.get("Last-Event-ID", type=int)
+    if since is None:
+        since = request.args.get("since", type=int)
+    # Connections are borrowed per poll, so an idle stream doesn't pin one
+    pool = get_pool(readonly=True)
+
+    def events():
+        nonlocal since
+        last_sent = time.monotonic()
+        while not server_stopping.is_set():
+            conn = pool.acquire()
+            try:
+                feed = read_changes(conn, since, visibility_level)
+            finally:
+                pool.release(conn)
+            if feed["reset"]:
+                yield f"event: reset\ndata: {json.dumps({'next': feed['next']})}\n\n"
+                return
+            for change in feed["changes"]:
+                yield f"id: {change['seq']}\nevent: change\ndata: {json.dumps(change)}\n\n"
+                last_sent = time.monotonic()
+            since = feed["next"]
+            if feed["has_more"]:
+                continue
+            if time.monotonic() - last_sent >= CHANGES_KEEPALIVE:
+                yield ": keepalive\n\n"
+                last_sent = time.monotonic()
+            with changes_condition:
+                changes_condition.wait(CHANGES_POLL_INTERVAL)
+
+    return Response(events(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.cli.command("compact-changes")
+def compact_changes_command():
+    """Compact the change log now instead of waiting for the writer to."""
+    removed = get_write_queue().submit(compact_change_log)
+    print(f"Removed {removed} change log entries.")
+
+
+# Sort keys accepted by /search, and the result field each one is read back from
+SEARCH_SORT_MAPPING = {"stars": "n.rating", "date": "n.date", "visibility": "n.visibility", "mmr": "n.mmr", "relevance": "-fh.rank"}
+SEARCH_SORT_FIELDS = {"stars": "rating", "date": "date", "visibility": "visibility", "mmr": "mmr", "relevance": "relevance"}
+MAX_SEARCH_LIMIT = 500
+
+
+def encode_search_cursor(sort_criteria, row):
+    sort_field = sort_criteria.split("-")[0]
+    payload = json.dumps([sort_criteria, row[SEARCH_SORT_FIELDS[sort_field]], row["note_id"]])
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii")
+
+
+def decode_search_cursor(cursor, sort_criteria):
+    """Return (last_sort_value, last_note_id), or None if the cursor is invalid for this sort."""
+    if not isinstance(cursor, str):
+        return None
+    try:
+        criteria, value, note_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, TypeError):
+        return None
+    if criteria != sort_criteria or not isinstance(note_id, int) or not isinstance(value, (int, float, str, type(None))):
+        return None
+    return value, note_id
+
+
+def keyset_condition(sort_column, direction, after):
+    """WHERE clause (and params) for rows strictly after `after` in ORDER BY sort_column, note_id.
+
+    SQLite sorts NULLs first ascending and last descending, and a row-value
+    comparison against NULL is never true, so a NULL sort key gets its own branch.
+    """
+    value, note_id = after
+    if direction == "DESC":
+        if value is None:
+            return f"({sort_column} IS NULL AND n.note_id < ?)", [note_id]
+        return f"(({sort_column}, n.note_id) < (?, ?) OR {sort_column} IS NULL)", [value, note_id]
+    if value is None:
+        return f"(({sort_column} IS NULL AND n.note_id > ?) OR {sort_column} IS NOT NULL)", [note_id]
+    return f"({sort_column}, n.note_id) > (?, ?)", [value, note_id]
+
+
+class SearchCache:
+    """Bounded LRU of serialized /search responses for one data version.
+
+    Every committed write bumps the data version (the write generation), so
+    the whole cache is dropped the first time a newer version is seen.
+    Limited both by entry count and by total body bytes.
+    """
+
+    def __init__(self, max_entries=SEARCH_CACHE_SIZE, max_bytes=SEARCH_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.generation = None
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def _check_generation(self, generation):
+        if generation != self.generation:
+            if self._entries:
+                self.counters["invalidations"] += 1
+            self._entries.clear()
+            self._bytes = 0
+            self.generation = generation
+
+    def get(self, key, generation):
+        with self._lock:
+            self._check_generation(generation)
+            body = self._entries.get(key)
+            if body is None:
+                self.counters["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.counters["hits"] += 1
+            return body
+
+    def set(self, key, generation, body):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            # The version may have moved while the query ran; don't cache into a newer generation
+            if generation != self.generation:
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._entries[key] = body
+            self._bytes += len(body)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.counters["evictions"] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+            stats["generation"] = self.generation
+        return stats
+
+
+search_cache = SearchCache()
+
+
+def cached_search_response(key, generation, payload):
+    body = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    search_cache.set(key, generation, body)
+    return app.response_class(body, mimetype="application/json")
+
+
+@app.route("/search_cache_stats", methods=["GET"])
+def search_cache_stats():
+    return jsonify(search_cache.stats())
+
+
+SEARCH_COLUMNS = "n.note_id, n.text, n.author, n.date, n.rating, n.source, n.visibility, n.mmr, n.mmr_matches, n.tag_names AS tags"
+
+# Relative per-row costs used by plan_search
+SEARCH_COST_SCAN = 1.0  # walking a sort index and testing the tag bitmap
+SEARCH_COST_LOOKUP = 2.0  # rowid lookup plus its share of the sort
+
+
+class TermEstimates:
+    """Per-term document counts from NotesFTSVocab, cached per data version."""
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self._counts = {}
+        self._version = None
+        self._lock = threading.Lock()
+
+    def count(self, db, term, version):
+        with self._lock:
+            if version != self._version:
+                self._counts.clear()
+                self._version = version
+            count = self._counts.get(term)
+        if count is not None:
+            return count
+        # Prefix match: every vocabulary term in [term, next string after the prefix)
+        upper = term[:-1] + chr(ord(term[-1]) + 1)
+        try:
+            count = db.execute("SELECT COALESCE(SUM(doc), 0) FROM NotesFTSVocab WHERE term >= ? AND term < ?", (term, upper)).fetchone()[0]
+        except sqlite3.OperationalError:
+            count = None
+        with self._lock:
+            if len(self._counts) < self.max_entries:
+                self._counts[term] = count
+        return count
+
+
+term_estimates = TermEstimates()
+
+
+def plan_search(db, selected_tags, search_text, match_query, visibility_level, limit, generation):
+    """Choose what drives a search and estimate its cost.
+
+    Strategies:
+      tags -- fetch the tag bitmap's survivors by rowid, sort them, apply the text filter on top
+      text -- let the FTS hits drive and test each against the tag bitmap
+      scan -- walk the sort index and test each row against the tag bitmap, stopping
+              as soon as the page is full
+
+    Tag cardinalities are exact (from the tag index); text cardinalities are
+    estimated from the FTS vocabulary as the rarest term's document count.
+    """
+    index = tag_index.sync(db)
+    matching = index.matching(selected_tags, visibility_level)
+    tag_matches = bitmap_count(matching)
+    visible_notes = bitmap_count(index.matching((), visibility_level))
+
+    text_matches = None
+    if match_query:
+        estimates = [term_estimates.count(db, term, generation) for term in fts_terms(search_text)]
+        if None not in estimates:
+            text_matches = min(estimates)
+
+    # A page of limit + 1 rows needs this many rows scanned when tag matches are spread evenly
+    if limit is None:
+        scan_rows = visible_notes
+    else:
+        scan_rows = min(visible_notes, (limit + 1) * visible_notes / max(tag_matches, 1))
+
+    costs = {}
+    if match_query:
+        text_rows = text_matches if text_matches is not None else visible_notes
+        costs["text"] = text_rows * SEARCH_COST_LOOKUP
         if selected_tags:
-            tag_placeholders = ",".join("?" for _ in selected_tags)
-            params.extend(selected_tags)
-        else:
-            tag_placeholders = "SELECT tag_id FROM Tags"
+            costs["tags"] = tag_matches * SEARCH_COST_LOOKUP + text_rows * SEARCH_COST_SCAN
+    else:
+        costs["scan"] = scan_rows * SEARCH_COST_SCAN
+        if selected_tags:
+            costs["tags"] = tag_matches * SEARCH_COST_LOOKUP
+
+    strategy = min(costs, key=costs.get)
+    return {
+        "strategy": strategy,
+        "costs": {name: round(cost, 1) for name, cost in costs.items()},
+        "estimates": {"tag_matches": tag_matches, "text_matches": text_matches, "visible_notes": visible_notes},
+        "matching": matching,
+    }
+
+
+def run_search(db, plan, search_text, match_query, visibility_level, sort_column, direction, after=None, limit=None, count_only=False):
+    """Execute a plan from plan_search; returns matching rows (or their count)."""
+    strategy = plan["strategy"]
+    columns = "n.note_id" if count_only else SEARCH_COLUMNS
+    with_clause = ""
+    from_clause = "Notes n"
+    conditions = []
+    params = []
+
+    if match_query:
+        ranked = "fh.rank" in sort_column
+        with_clause = "WITH" + (FTS_RANKED_HITS_CTE if ranked else FTS_HITS_CTE)
+        from_clause += "\n        JOIN fts_hits fh ON fh.note_id = n.note_id"
+        if ranked and not count_only:
+            columns += ", -fh.rank AS relevance"
+        params.append(match_query)
+
+    if strategy == "tags":
+        conditions.append("n.note_id IN (SELECT value FROM json_each(?))")
+        params.append(json.dumps(bitmap_ids(plan["matching"])))
+    conditions.append("n.visibility <= ?")
+    params.append(visibility_level)
+
+    if search_text and not match_query:
+        # Nothing indexable in the text (e.g. only punctuation), fall back to a scan
+        conditions.append("n.text LIKE ?")
+        params.append(f"%{search_text}%")
+
+    if after is not None:
+        # Keyset pagination: continue strictly after the last (sort key, note_id) seen
+        condition, condition_params = keyset_condition(sort_column, direction, after)
+        conditions.append(condition)
+        params.extend(condition_params)
 
-        query = query.format(tag_placeholders)
-        params.extend([len(selected_tags), visibility_level])
+    query = f"""
+        {with_clause}
+        SELECT {columns}
+        FROM {from_clause}
+        WHERE {" AND ".join(conditions)}"""
+    if not count_only:
+        query += f"\n        ORDER BY {sort_column} {direction}, n.note_id {direction}"
+
+    if strategy == "tags":
+        if limit is not None:
+            query += "\n        LIMIT ?"
+            params.append(limit)
+        rows = db.execute(query, params)
+        if count_only:
+            return len(rows.fetchall())
+        return [dict(row) for row in rows]
+
+    # Other strategies stream rows and keep those the tag bitmap allows
+    matching = plan["matching"]
+    bits = matching.to_bytes((matching.bit_length() + 7) // 8, "little")
+    size = len(bits)
+    results = []
+    count = 0
+    for row in db.execute(query, params):
+        note_id = row[0]
+        if note_id >> 3 < size and bits[note_id >> 3] >> (note_id & 7) & 1:
+            if count_only:
+                count += 1
+                continue
+            results.append(dict(row))
+            if limit is not None and len(results) >= limit:
+                break
+    return count if count_only else results
+
+
+def add_snippets(db, rows, match_query):
+    """Fill in snippet and relevance for text search results."""
+    if not rows:
+        return
+    # The unary + keeps the rowid filter away from FTS5, which would otherwise re-run
+    # the MATCH once per id; this way it's one pass, with snippets built only for these rows
+    query = f"SELECT rowid, -bm25(NotesFTS), {FTS_SNIPPET} FROM NotesFTS WHERE NotesFTS MATCH ? AND +rowid IN (SELECT value FROM json_each(?))"
+    note_ids = [row["note_id"] for row in rows]
+    hits = {note_id: (relevance, snippet) for note_id, relevance, snippet in db.execute(query, (match_query, json.dumps(note_ids)))}
+    for row in rows:
+        relevance, snippet = hits.get(row["note_id"], (None, None))
+        row["snippet"] = snippet
+        row.setdefault("relevance", relevance)
 
-        if search_text:
-            query += " AND n.text LIKE ?"
-            params.append(f"%{search_text}%")
 
-        query += " GROUP BY n.note_id"
+@app.route("/search", methods=["POST"])
+@app.route("/search2", methods=["POST"])
+def search():
+    """Search notes by tags (respecting the hierarchy), text, or both.
 
-        sort_field, sort_order = sort_criteria.split("-")
-        sort_mapping = {"stars": "n.rating", "date": "n.date", "visibility": "n.visibility", "mmr": "n.mmr"}  # Add this line
-        query += f" ORDER BY {sort_mapping[sort_field]} {'DESC' if sort_order == 'desc' else 'ASC'}"
+    Without limit or cursor the whole result list is returned; with either,
+    a page plus next_cursor. /search2 is kept as an alias for old clients.
+    Pass debug: true to get the planner's decision back as a plan field.
+    """
+    try:
+        db = get_read_db()
+        data = request.json
 
-        app.logger.debug(f"Search query: {query}")
-        app.logger.debug(f"Search params: {params}")
+        selected_tags = data.get("tags", [])
+        search_text = data.get("text", "")
+        sort_criteria = data.get("sortCriteria", "stars-desc")
+        limit = data.get("limit")
+        page_cursor = data.get("cursor")
+        count_only = data.get("count_only", False)
+        debug = bool(data.get("debug", False))
 
-        cursor = db.execute(query, params)
-        results = cursor.fetchall()
+        if limit is not None and (isinstance(limit, bool) or not isinstance(limit, int) or limit < 1):
+            return jsonify({"error": "limit must be a positive integer"}), 400
 
-        filtered_results = [dict(row) for row in results if row["visibility"] <= visibility_level]
+        visibility_level = request_visibility_level(data, selected_tags)
+        if visibility_level is None:
+            return jsonify({"error": "Invalid or expired token"}), 401
 
-        app.logger.debug(f"Filtered search results: {filtered_results}")
+        match_query = build_fts_query(search_text) if search_text else None
 
-        return jsonify(filtered_results)
+        sort_field, sort_order = sort_criteria.split("-")
+        if sort_field == "relevance" and not match_query:
+            sort_field, sort_order = "stars", "desc"
+            sort_criteria = "stars-desc"
+        sort_column = SEARCH_SORT_MAPPING[sort_field]
+        direction = "DESC" if sort_order == "desc" else "ASC"
+
+        # Read the version before querying so a cached body is never older than its generation
+        generation = get_data_version(db)
+        cache_key = (
+            tuple(sorted(set(selected_tags))),
+            match_query or search_text,
+            visibility_level,
+            sort_criteria,
+            limit,
+            page_cursor,
+            bool(count_only),
+        )
+        # Debug output times this very request, so it never comes from (or goes into) the cache
+        body = None if debug else search_cache.get(cache_key, generation)
+        if body is not None:
+            return app.response_class(body, mimetype="application/json")
+
+        after = None
+        if page_cursor:
+            after = decode_search_cursor(page_cursor, sort_criteria)
+            if after is None:
+                return jsonify({"error": "Invalid cursor"}), 400
+        paged = limit is not None or page_cursor is not None
+        if paged:
+            limit = min(limit or MAX_SEARCH_LIMIT, MAX_SEARCH_LIMIT)
+
+        started = time.perf_counter()
+        plan = plan_search(db, selected_tags, search_text, match_query, visibility_level, limit if paged else None, generation)
+
+        if count_only and not search_text:
+            # The tag index already knows exactly which notes qualify
+            plan["strategy"] = "bitmap"
+            payload = {"count": plan["estimates"]["tag_matches"]}
+        elif count_only:
+            payload = {"count": run_search(db, plan, search_text, match_query, visibility_level, sort_column, direction, count_only=True)}
+        else:
+            # Fetch one extra row to learn whether another page exists
+            results = run_search(db, plan, search_text, match_query, visibility_level, sort_column, direction, after=after, limit=limit + 1 if paged else None)
+            next_cursor = None
+            if paged and len(results) > limit:
+                results = results[:limit]
+                next_cursor = encode_search_cursor(sort_criteria, results[-1])
+            if match_query:
+                add_snippets(db, results, match_query)
+            payload = {"results": results, "next_cursor": next_cursor} if paged else results
+
+        if debug:
+            if isinstance(payload, list):
+                payload = {"results": payload}
+            plan.pop("matching")
+            plan["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 3)
+            payload["plan"] = plan
+            return jsonify(payload)
+        return cached_search_response(cache_key, generation, payload)
     except Exception as e:
         app.logger.error(f"Error in search: {str(e)}", exc_info=True)
         return jsonify({"error": str(e)}), 500
 
 
+def _add_note(cursor, data):
+    cursor.execute(
+        """
+    INSERT INTO Notes (author, date, rating, source, visibility, text)
+    VALUES (?, ?, ?, ?, ?, ?)
+    """,
+        (
+            data["author"],
+            int(datetime.now().timestamp()),
+            data["rating"],
+            data["source"],
+            data["visibility"],  # Add this line to include visibility
+            data["text"],
+        ),
+    )
+
+    note_id = cursor.lastrowid
+
+    cursor.executemany("INSERT INTO NoteTags (note_id, tag_id) VALUES (?, ?)", [(note_id, tag_id) for tag_id in data["tags"]])
+    refresh_tag_names(cursor, [note_id])
+    log_note_changes(cursor, [note_id])
+    get_write_queue().after_commit(tag_index.add_note, note_id, data["visibility"], data["tags"])
+    return note_id
+
+
 @app.route("/add_note", methods=["POST"])
 def add_note():
-    db = get_db()
     data = request.json
-    cursor = db.cursor()
 
     try:
-        cursor.execute(
-            """
-        INSERT INTO Notes (author, date, rating, source, visibility, text)
-        VALUES (?, ?, ?, ?, ?, ?)
-        """,
-            (
-                data["author"],
-                int(datetime.now().timestamp()),
-                data["rating"],
-                data["source"],
-                data["visibility"],  # Add this line to include visibility
-                data["text"],
-            ),
-        )
+        note_id = get_write_queue().submit(_add_note, data)
+        mmr_sampler.invalidate()
+        return jsonify({"success": True, "note_id": note_id})
+    except WriteUnavailable as e:
+        return jsonify({"success": False, "error": str(e)}), 503
+    except Exception as e:
+        app.logger.error(f"Error adding note: {str(e)}")  # Add this line for debugging
+        return jsonify({"success": False, "error": str(e)}), 500
 
-        note_id = cursor.lastrowid
 
-        for tag_id in data["tags"]:
-            cursor.execute("INSERT INTO NoteTags (note_id, tag_id) VALUES (?, ?)", (note_id, tag_id))
+NOTE_EXPORT_FIELDS = ("note_id", "author", "date", "rating", "source", "visibility", "text", "mmr", "mmr_matches")
+
+
+def parse_import_line(line):
+    """Parse one NDJSON line into (note fields, tag readable_ids)."""
+    record = json.loads(line)
+    if not isinstance(record, dict):
+        raise ValueError("Expected a JSON object")
+    if not record.get("text"):
+        raise ValueError("Missing text")
+    tags = record.get("tags", [])
+    if not isinstance(tags, list):
+        raise ValueError("tags must be a list of readable_ids")
+    for field in ("rating", "visibility"):
+        if record.get(field, 3) not in (1, 2, 3, 4, 5):
+            raise ValueError(f"{field} must be an integer from 1 to 5")
+    note = (
+        record.get("author"),
+        int(record.get("date") or datetime.now().timestamp()),
+        record.get("rating", 3),
+        record.get("source"),
+        record.get("visibility", 3),
+        record["text"],
+        record.get("mmr", 1500),
+        record.get("mmr_matches", 0),
+    )
+    return note, tags
 
-        db.commit()
-        return jsonify({"success": True, "note_id": note_id})
+
+def _import_notes(cursor, chunk):
+    """Insert a chunk of (line_number, note, tags) rows; returns (imported, errors)."""
+    cursor.execute("SELECT readable_id, tag_id FROM Tags")
+    tag_ids = dict(cursor.fetchall())
+
+    errors = []
+    rows = []
+    for line_number, note, tags in chunk:
+        missing = [readable_id for readable_id in tags if readable_id not in tag_ids]
+        if missing:
+            errors.append({"line": line_number, "error": f"Unknown tags: {', '.join(map(str, missing))}"})
+        else:
+            rows.append((note, tags))
+    if not rows:
+        return 0, errors
+
+    # executemany can't hand back rowids, so allocate them up front; the writer
+    # holds the write lock, and sqlite_sequence keeps deleted ids from being reused
+    cursor.execute(
+        """
+        SELECT MAX(COALESCE((SELECT MAX(note_id) FROM Notes), 0),
+                   COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'Notes'), 0))
+    """
+    )
+    first_id = cursor.fetchone()[0] + 1
+    cursor.executemany(
+        """
+    INSERT INTO Notes (note_id, author, date, rating, source, visibility, text, mmr, mmr_matches)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """,
+        [(first_id + i,) + note for i, (note, _) in enumerate(rows)],
+    )
+    cursor.executemany(
+        "INSERT OR IGNORE INTO NoteTags (note_id, tag_id) VALUES (?, ?)",
+        [(first_id + i, tag_ids[readable_id]) for i, (_, tags) in enumerate(rows) for readable_id in tags],
+    )
+    refresh_tag_names(cursor, range(first_id, first_id + len(rows)))
+    log_note_changes(cursor, range(first_id, first_id + len(rows)))
+    # Cheaper to rebuild the tag index once than to grow every bitmap note by note
+    get_write_queue().after_commit(tag_index.invalidate)
+    return len(rows), errors
+
+
+def import_notes(lines, chunk_size=IMPORT_CHUNK_SIZE, progress=None):
+    """Bulk-load notes from NDJSON lines through the write queue.
+
+    Each chunk is one write-queue job, so it commits (or fails) as a unit
+    without holding the write lock for the whole import. Bad lines are
+    skipped and reported. progress(imported, lines_read) runs after each chunk.
+    """
+    write_queue = get_write_queue()
+    result = {"imported": 0, "skipped": 0, "errors": []}
+
+    def record_error(error):
+        result["skipped"] += 1
+        if len(result["errors"]) < MAX_IMPORT_ERRORS:
+            result["errors"].append(error)
+
+    def flush(chunk, lines_read):
+        try:
+            imported, errors = write_queue.submit(_import_notes, chunk)
+        except WriteUnavailable:
+            raise
+        except Exception as e:
+            imported, errors = 0, [{"line": chunk[0][0], "error": f"Chunk of {len(chunk)} notes failed: {str(e)}"}]
+            result["skipped"] += len(chunk) - 1
+        result["imported"] += imported
+        for error in errors:
+            record_error(error)
+        if progress:
+            progress(result["imported"], lines_read)
+
+    chunk = []
+    line_number = 0
+    for line_number, line in enumerate(lines, start=1):
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        if not line.strip():
+            continue
+        try:
+            note, tags = parse_import_line(line)
+        except (ValueError, TypeError) as e:
+            record_error({"line": line_number, "error": str(e)})
+            continue
+        chunk.append((line_number, note, tags))
+        if len(chunk) >= chunk_size:
+            flush(chunk, line_number)
+            chunk = []
+    if chunk:
+        flush(chunk, line_number)
+
+    if result["imported"]:
+        mmr_sampler.invalidate()
+    result["errors"].sort(key=lambda error: error["line"])
+    return result
+
+
+@app.route("/import_notes", methods=["POST"])
+def import_notes_route():
+    def log_progress(imported, lines_read):
+        app.logger.info(f"Import progress: {imported} notes from {lines_read} lines")
+
+    try:
+        result = import_notes(request.stream, progress=log_progress)
+        return jsonify({"success": True, **result})
+    except WriteUnavailable as e:
+        return jsonify({"success": False, "error": str(e)}), 503
     except Exception as e:
-        db.rollback()
-        app.logger.error(f"Error adding note: {str(e)}")  # Add this line for debugging
+        app.logger.error(f"Error importing notes: {str(e)}")
         return jsonify({"success": False, "error": str(e)}), 500
 
 
+def iter_notes_ndjson(db, max_visibility=5):
+    """Yield every visible note as an NDJSON line, streaming from the cursor."""
+    cursor = db.execute(
+        """
+    SELECT n.note_id, n.author, n.date, n.rating, n.source, n.visibility, n.text, n.mmr, n.mmr_matches,
+           (SELECT json_group_array(t.readable_id)
+            FROM NoteTags nt JOIN Tags t ON t.tag_id = nt.tag_id
+            WHERE nt.note_id = n.note_id) AS tags
+    FROM Notes n
+    WHERE n.visibility <= ?
+    ORDER BY n.note_id
+    """,
+        (max_visibility,),
+    )
+    for row in cursor:
+        note = {field: row[field] for field in NOTE_EXPORT_FIELDS}
+        note["tags"] = json.loads(row["tags"])
+        yield json.dumps(note, ensure_ascii=False) + "\n"
+
+
+@app.route("/export_notes", methods=["GET"])
+def export_notes():
+    """NDJSON of every note the ?token= from /auth may see (default level without one)."""
+    if "password" in request.args:
+        return jsonify({"error": PASSWORD_IN_QUERY_ERROR}), 400
+    visibility_level = query_visibility_level()
+    if visibility_level is None:
+        return jsonify({"error": "Invalid or expired token"}), 401
+    db = get_read_db()
+    return Response(stream_with_context(iter_notes_ndjson(db, visibility_level)), mimetype="application/x-ndjson")
+
+
+@app.cli.command("import-notes")
+@click.argument("path", type=click.File("rb"))
+@click.option("--chunk-size", default=IMPORT_CHUNK_SIZE, show_default=True)
+def import_notes_command(path, chunk_size):
+    """Bulk-load notes from an NDJSON file ('-' for stdin)."""
+    started = time.monotonic()
+
+    def report(imported, lines_read):
+        print(f"  {imported} notes imported, {lines_read} lines read ({time.monotonic() - started:.1f}s)")
+
+    result = import_notes(path, chunk_size=chunk_size, progress=report)
+    print(f"Imported {result['imported']} notes, skipped {result['skipped']}.")
+    for error in result["errors"]:
+        print(f"  line {error['line']}: {error['error']}")
+
+
+@app.cli.command("export-notes")
+@click.argument("path", type=click.File("w", encoding="utf-8"), default="-")
+def export_notes_command(path):
+    """Write all notes as NDJSON to a file ('-' for stdout)."""
+    db = get_read_db()
+    for line in iter_notes_ndjson(db):
+        path.write(line)
+
+
+@app.cli.command("hash-password")
+@click.argument("password")
+def hash_password_command(password):
+    """Print a password hash for use in DYNOTES_PASSWORDS_FILE."""
+    print(generate_password_hash(password))
+
+
+def create_app(database=None, migrate=True):
+    """Configure and return the app, e.g. `flask --app 'app:create_app()' run`.
+
+    Importing this module does no hashing or database work, so each worker
+    pays only for what it calls here: logging setup, the passwords file and
+    (unless migrate is False) bringing the schema up to date.
+    """
+    global DATABASE, PASSWORD_HASHES
+    if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+        raise RuntimeError(f"DyNotes needs SQLite {'.'.join(map(str, MIN_SQLITE_VERSION))} or newer, found {sqlite3.sqlite_version}")
+    logging.basicConfig(level=LOG_LEVEL)
+    # Records now reach the root handler; Flask's own would print them twice
+    app.logger.removeHandler(default_handler)
+    if database:
+        DATABASE = database
+    PASSWORD_HASHES = load_password_hashes()
+    if migrate:
+        init_db()
+    return app
+
+
+# Set when this worker starts draining, so long-lived streams end instead of holding it up
+server_stopping = threading.Event()
+
+
+class RequestTracker:
+    """WSGI middleware counting in-flight requests, so a worker can drain before exiting.
+
+    A request counts until its response iterable is closed, so streamed
+    responses are waited for too.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.active = 0
+        self._changed = threading.Condition()
+
+    def __call__(self, environ, start_response):
+        with self._changed:
+            self.active += 1
+        try:
+            return ClosingIterator(self.wsgi_app(environ, start_response), self._finished)
+        except BaseException:
+            self._finished()
+            raise
+
+    def _finished(self):
+        with self._changed:
+            self.active -= 1
+            self._changed.notify_all()
+
+    def wait_idle(self, timeout):
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while self.active:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._changed.wait(remaining)
+        return True
+
+
+def warm_worker():
+    """Fill this process's read pool and caches before it accepts traffic."""
+    with app.app_context():
+        tag_index.sync(get_read_db())
+    # The hot read endpoints, so serialized bodies, statement caches and templates are ready
+    client = app.test_client()
+    for path in ("/", "/tags", "/tag_relationships", "/graph", "/get_stats"):
+        client.get(path)
+    client.post("/search", json={"tags": [], "text": "", "sortCriteria": "date-desc", "limit": 1})
+    # Open the rest of the pool so the first burst of requests doesn't pay for connecting
+    pool = get_pool(readonly=True)
+    conns = [pool.acquire() for _ in range(SQLITE_POOL_SIZE)]
+    for conn in conns:
+        get_data_version(conn)
+        pool.release(conn)
+
+
+def run_worker(sock, drain_timeout):
+    """Serve requests on the shared listening socket until SIGTERM/SIGINT, then drain."""
+    warm_worker()
+    tracker = RequestTracker(app.wsgi_app)
+    host, port = sock.getsockname()[:2]
+    server = make_server(host, port, tracker, threaded=True, fd=sock.fileno())
+
+    def stop(signum, frame):
+        server_stopping.set()
+        # shutdown() waits for serve_forever to return, so it can't run on this thread
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    app.logger.info(f"Worker {os.getpid()} ready.")
+    server.serve_forever()
+
+    started = time.monotonic()
+    if not tracker.wait_idle(drain_timeout):
+        app.logger.warning(f"Worker {os.getpid()} stopping with {tracker.active} requests still running.")
+    if not get_write_queue().drain(max(0.0, drain_timeout - (time.monotonic() - started))):
+        app.logger.warning(f"Worker {os.getpid()} stopping with writes still queued.")
+    server.server_close()
+    close_pools()
+    app.logger.info(f"Worker {os.getpid()} stopped.")
+
+
+def serve(host, port, workers=SERVER_WORKERS, drain_timeout=SERVER_DRAIN_TIMEOUT):
+    """Pre-forking server: one listening socket shared by `workers` threaded processes.
+
+    Migrations run once here, in the parent, and every pooled connection is
+    closed before forking so no SQLite handle crosses into a worker. Workers
+    that die are replaced; SIGTERM/SIGINT stop them all gracefully.
+    """
+    if not hasattr(os, "fork"):
+        raise RuntimeError("flask serve needs os.fork; use `python app.py` on this platform")
+    create_app()
+    close_pools()
+
+    sock = socket.create_server((host, port), backlog=128)
+    sock.set_inheritable(True)
+    children = set()
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            # The parent's handlers would signal the siblings; run_worker installs its own
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            code = 0
+            try:
+                run_worker(sock, drain_timeout)
+            except BaseException:
+                app.logger.exception(f"Worker {os.getpid()} crashed.")
+                code = 1
+            finally:
+                os._exit(code)
+        children.add(pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    app.logger.info(f"Serving on http://{host}:{sock.getsockname()[1]} with {workers} workers.")
+    for _ in range(workers):
+        spawn()
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        children.discard(pid)
+        if not stopping:
+            app.logger.warning(f"Worker {pid} exited with status {status}, starting a replacement.")
+            time.sleep(1)
+            if not stopping:
+                spawn()
+    sock.close()
+
+
+@app.cli.command("serve")
+@click.option("--host", default="0.0.0.0")
+@click.option("--port", type=int, default=5000)
+@click.option("--workers", type=int, default=SERVER_WORKERS, show_default=True, help="Worker processes (DYNOTES_WORKERS)")
+@click.option("--drain-timeout", type=float, default=SERVER_DRAIN_TIMEOUT, show_default=True, help="Seconds a stopping worker waits for in-flight work")
+def serve_command(host, port, workers, drain_timeout):
+    """Run the production server: pre-forked workers with threaded request handling."""
+    serve(host, port, workers=workers, drain_timeout=drain_timeout)
+
+
 if __name__ == "__main__":
-    init_db()
+    create_app()
     app.run(debug=False, host="0.0.0.0")
     # app.run(debug=False, )
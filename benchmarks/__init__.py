@@ -0,0 +1,5 @@
+"""Synthetic corpus generator and endpoint benchmarks for DyNotes.
+
+python -m benchmarks.corpus bench.db --notes 20000 --tags 300 --shape deep
+python -m benchmarks.harness bench.db --output results/$(date +%Y%m%d-%H%M).json
+"""
@@ -0,0 +1,184 @@
+import argparse
+import math
+import os
+import random
+import sqlite3
+import time
+
+from app import apply_migrations, rebuild_stats, rebuild_tag_closure, refresh_tag_names
+
+"""
+
+example usage:
+python -m benchmarks.corpus bench.db --notes 20000 --tags 300 --shape deep --seed 1
+
+"""
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "schema.sql")
+
+# Page cache for the load; the FTS index and note indexes outgrow the 2 MB default fast
+LOAD_CACHE_KB = 256 * 1024
+
+# Their secondary indexes and triggers are set aside while notes are inserted
+BULK_TABLES = ("Notes", "NoteTags")
+
+# Zipf-ish vocabulary: a few very common words and a long tail, like real notes
+VOCABULARY_SIZE = 5000
+SYLLABLES = ["ka", "lo", "mi", "ne", "ru", "sa", "ti", "vo", "en", "ar", "is", "on", "el", "um", "st", "tr", "pl", "qu"]
+
+
+def make_vocabulary(rng, size=VOCABULARY_SIZE):
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 4))))
+    return sorted(words)
+
+
+def make_text(rng, vocabulary, weights, mean_words):
+    # Note lengths are roughly log-normal: mostly short, some long
+    length = max(1, int(rng.lognormvariate(math.log(mean_words), 0.8)))
+    return " ".join(rng.choices(vocabulary, cum_weights=weights, k=length))
+
+
+def make_tag_edges(rng, tags, shape, fanout, extra_parents):
+    """Return (parent, child) index pairs forming a DAG over range(tags).
+
+    deep: a few long chains of descending depth; wide: a shallow tree with
+    many children per node. extra_parents adds cross links to earlier tags,
+    which keeps the graph acyclic.
+    """
+    edges = set()
+    if shape == "deep":
+        chains = max(1, fanout)
+        for i in range(chains, tags):
+            edges.add((i - chains, i))
+    else:
+        for i in range(1, tags):
+            edges.add(((i - 1) // max(1, fanout), i))
+    for child in range(1, tags):
+        if rng.random() < extra_parents:
+            parent = rng.randrange(child)
+            edges.add((parent, child))
+    return sorted(edges)
+
+
+def suspend_indexes_and_triggers(conn, tables=BULK_TABLES):
+    """Drop the secondary indexes and triggers on tables; returns the SQL that recreates them."""
+    placeholders = ",".join("?" for _ in tables)
+    rows = conn.execute(
+        f"SELECT type, name, sql FROM sqlite_master WHERE type IN ('index', 'trigger') AND sql IS NOT NULL AND tbl_name IN ({placeholders})",
+        tables,
+    ).fetchall()
+    for kind, name, _ in rows:
+        conn.execute(f"DROP {kind.upper()} {name}")
+    return [sql for _, _, sql in rows]
+
+
+def generate_corpus(db_path, notes=10000, tags=200, shape="wide", fanout=8, extra_parents=0.05, tags_per_note=3, mean_words=40, seed=0):
+    """Build a fresh database at db_path from schema.sql and fill it deterministically."""
+    rng = random.Random(seed)
+    if os.path.exists(db_path):
+        os.remove(db_path)
+
+    conn = sqlite3.connect(db_path)
+    # A half-written corpus is thrown away anyway, so skip the journal and fsyncs
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute(f"PRAGMA cache_size = -{LOAD_CACHE_KB}")
+    conn.execute("PRAGMA foreign_keys = ON")
+    with open(SCHEMA_PATH) as f:
+        conn.executescript(f.read())
+    apply_migrations(conn)
+    # Building indexes, the FTS index and counters once at the end beats maintaining them per row
+    restore_sql = suspend_indexes_and_triggers(conn)
+
+    cursor = conn.cursor()
+    cursor.executemany("INSERT INTO Tags (tag_id, name, readable_id) VALUES (?, ?, ?)", [(i + 1, f"tag {i}", f"t{i}") for i in range(tags)])
+    edges = make_tag_edges(rng, tags, shape, fanout, extra_parents)
+    cursor.executemany("INSERT INTO TagRelationships (parent_tag_id, child_tag_id) VALUES (?, ?)", [(p + 1, c + 1) for p, c in edges])
+    rebuild_tag_closure(cursor)
+
+    vocabulary = make_vocabulary(rng)
+    weights = []
+    total = 0.0
+    for rank in range(1, len(vocabulary) + 1):
+        total += 1.0 / rank
+        weights.append(total)
+
+    # Tag popularity is skewed too, so some tags have many notes and most have few
+    tag_weights = []
+    total = 0.0
+    for rank in range(1, tags + 1):
+        total += 1.0 / math.sqrt(rank)
+        tag_weights.append(total)
+    tag_ids = list(range(1, tags + 1))
+
+    now = int(time.time())
+    batch = 5000
+    for start in range(0, notes, batch):
+        rows = []
+        note_tags = []
+        for note_id in range(start + 1, min(notes, start + batch) + 1):
+            rows.append(
+                (
+                    note_id,
+                    f"author {rng.randrange(50)}",
+                    now - rng.randrange(5 * 365 * 24 * 3600),
+                    rng.randint(1, 5),
+                    f"source {rng.randrange(200)}",
+                    rng.choices((1, 2, 3, 4, 5), weights=(40, 25, 20, 10, 5))[0],
+                    make_text(rng, vocabulary, weights, mean_words),
+                    int(rng.gauss(1500, 120)),
+                    rng.randrange(30),
+                )
+            )
+            for tag_id in set(rng.choices(tag_ids, cum_weights=tag_weights, k=rng.randint(1, tags_per_note))):
+                note_tags.append((note_id, tag_id))
+        cursor.executemany(
+            "INSERT INTO Notes (note_id, author, date, rating, source, visibility, text, mmr, mmr_matches) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+        cursor.executemany("INSERT INTO NoteTags (note_id, tag_id) VALUES (?, ?)", note_tags)
+
+    for sql in restore_sql:
+        cursor.execute(sql)
+    cursor.execute("INSERT INTO NotesFTS(NotesFTS) VALUES ('rebuild')")
+    refresh_tag_names(cursor)
+    rebuild_stats(cursor)
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.close()
+    return {"notes": notes, "tags": tags, "edges": len(edges), "shape": shape, "fanout": fanout, "seed": seed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic DyNotes database.")
+    parser.add_argument("db_path", help="Where to write the database (overwritten)")
+    parser.add_argument("--notes", type=int, default=10000)
+    parser.add_argument("--tags", type=int, default=200)
+    parser.add_argument("--shape", choices=("deep", "wide"), default="wide", help="Long chains or a shallow bushy tree")
+    parser.add_argument("--fanout", type=int, default=8, help="Children per tag (wide) or number of chains (deep)")
+    parser.add_argument("--extra_parents", type=float, default=0.05, help="Chance a tag gets a second parent")
+    parser.add_argument("--tags_per_note", type=int, default=3)
+    parser.add_argument("--mean_words", type=int, default=40)
+    parser.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args()
+    started = time.perf_counter()
+    info = generate_corpus(
+        args.db_path,
+        notes=args.notes,
+        tags=args.tags,
+        shape=args.shape,
+        fanout=args.fanout,
+        extra_parents=args.extra_parents,
+        tags_per_note=args.tags_per_note,
+        mean_words=args.mean_words,
+        seed=args.seed,
+    )
+    print(f"Generated {info['notes']} notes, {info['tags']} tags and {info['edges']} edges in {time.perf_counter() - started:.1f}s.")
+
+
+if __name__ == "__main__":
+    main()
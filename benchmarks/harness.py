@@ -0,0 +1,223 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+import app as dynotes
+
+"""
+
+example usage (from the repository root):
+python -m benchmarks.corpus bench.db --notes 20000 --seed 1
+python -m benchmarks.harness bench.db --iterations 200 --output results.json
+
+# only some scenarios, with the /search result cache left on
+python -m benchmarks.harness bench.db --scenarios search search_text --search_cache
+
+"""
+
+PASSWORD = "pw5"
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Run in a fresh interpreter per sample, so imports are measured cold
+STARTUP_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.create_app(sys.argv[1])
+ready = time.perf_counter()
+print(json.dumps({"import": imported - started, "create_app": ready - imported}))
+"""
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def peak_rss_kb():
+    # ru_maxrss is KiB on Linux but bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if platform.system() == "Darwin" else peak
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def count_rows(payload):
+    if isinstance(payload, list):
+        return len(payload)
+    if isinstance(payload, dict) and "results" in payload:
+        return len(payload["results"])
+    return 1
+
+
+class Corpus:
+    """What the scenarios need to know about the benchmark database."""
+
+    def __init__(self, db_path):
+        conn = sqlite3.connect(db_path)
+        self.tag_ids = [row[0] for row in conn.execute("SELECT tag_id FROM Tags")]
+        self.root_ids = [row[0] for row in conn.execute("SELECT tag_id FROM Tags WHERE tag_id NOT IN (SELECT child_tag_id FROM TagRelationships)")]
+        self.note_ids = [row[0] for row in conn.execute("SELECT note_id FROM Notes")]
+        # Common words make for realistic, non-trivial text searches
+        self.words = [row[0] for row in conn.execute("SELECT term FROM NotesFTS_vocab ORDER BY doc DESC LIMIT 200")] if self._has_vocab(conn) else []
+        conn.close()
+
+    @staticmethod
+    def _has_vocab(conn):
+        try:
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS temp.NotesFTS_vocab USING fts5vocab(main, NotesFTS, row)")
+            return True
+        except sqlite3.OperationalError:
+            return False
+
+
+def search_body(rng, corpus, text=False):
+    body = {"tags": rng.sample(corpus.tag_ids, k=rng.randint(1, 2)), "text": "", "password": PASSWORD, "sortCriteria": "stars-desc"}
+    if text and corpus.words:
+        body["tags"] = rng.sample(corpus.root_ids, k=1) if corpus.root_ids else []
+        body["text"] = rng.choice(corpus.words)
+    return body
+
+
+# name -> (method, path, body factory)
+SCENARIOS = {
+    "search": ("POST", "/search", lambda rng, corpus: search_body(rng, corpus)),
+    "search_text": ("POST", "/search", lambda rng, corpus: search_body(rng, corpus, text=True)),
+    "search_page": ("POST", "/search", lambda rng, corpus: {**search_body(rng, corpus), "limit": 50}),
+    "search2": ("POST", "/search2", lambda rng, corpus: search_body(rng, corpus)),
+    "search2_text": ("POST", "/search2", lambda rng, corpus: search_body(rng, corpus, text=True)),
+    "get_mmr_notes": ("POST", "/get_mmr_notes", lambda rng, corpus: {"tags": rng.sample(corpus.root_ids or corpus.tag_ids, k=1), "password": PASSWORD}),
+    "update_mmr": ("POST", "/update_mmr", lambda rng, corpus: dict(zip(("winner_id", "loser_id"), rng.sample(corpus.note_ids, k=2)))),
+    "tags": ("GET", "/tags", None),
+    "graph": ("GET", "/graph", None),
+    "get_stats": ("GET", "/get_stats", None),
+}
+
+
+def run_scenario(client, name, corpus, iterations, warmup, seed):
+    method, path, make_body = SCENARIOS[name]
+    rng = random.Random(f"{seed}-{name}")
+    latencies = []
+    rows = 0
+    errors = 0
+    for i in range(warmup + iterations):
+        body = make_body(rng, corpus) if make_body else None
+        started = time.perf_counter()
+        response = client.open(path, method=method, json=body)
+        elapsed = time.perf_counter() - started
+        if i < warmup:
+            continue
+        latencies.append(elapsed)
+        if response.status_code != 200:
+            errors += 1
+        else:
+            rows += count_rows(response.get_json())
+
+    total = sum(latencies)
+    return {
+        "iterations": iterations,
+        "errors": errors,
+        "rows": rows,
+        "rows_per_s": rows / total if total else None,
+        "requests_per_s": iterations / total if total else None,
+        "latency_ms": {
+            "mean": statistics.mean(latencies) * 1000,
+            "p50": percentile(latencies, 0.50) * 1000,
+            "p95": percentile(latencies, 0.95) * 1000,
+            "p99": percentile(latencies, 0.99) * 1000,
+            "max": max(latencies) * 1000,
+        },
+        # ru_maxrss never goes down, so this includes every scenario run before this one
+        "cumulative_peak_rss_kb": peak_rss_kb(),
+    }
+
+
+def measure_startup(db_path, runs):
+    """Time importing the app and create_app() in fresh processes, as a new worker would."""
+    samples = {"import": [], "create_app": [], "process": []}
+    env = {**os.environ, "DYNOTES_LOG_LEVEL": "WARNING"}
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT, os.path.abspath(db_path)], cwd=REPO_ROOT, env=env, capture_output=True, text=True, check=True)
+        samples["process"].append(time.perf_counter() - started)
+        for name, seconds in json.loads(result.stdout.strip().splitlines()[-1]).items():
+            samples[name].append(seconds)
+    return {f"{name}_ms": {"p50": percentile(values, 0.50) * 1000, "max": max(values) * 1000} for name, values in samples.items()}
+
+
+def run_benchmarks(db_path, scenarios, iterations=100, warmup=10, seed=0, search_cache=False, startup_runs=5):
+    startup = None
+    if startup_runs:
+        startup = measure_startup(db_path, startup_runs)
+        print(f"{'startup':>14}: import {startup['import_ms']['p50']:7.2f}ms  create_app {startup['create_app_ms']['p50']:7.2f}ms  process {startup['process_ms']['p50']:7.2f}ms")
+
+    dynotes.create_app(db_path)
+    if not search_cache:
+        dynotes.search_cache.max_entries = 0
+    corpus = Corpus(db_path)
+    client = dynotes.app.test_client()
+
+    results = {}
+    for name in scenarios:
+        results[name] = run_scenario(client, name, corpus, iterations, warmup, seed)
+        latency = results[name]["latency_ms"]
+        print(f"{name:>14}: p50 {latency['p50']:7.2f}ms  p95 {latency['p95']:7.2f}ms  p99 {latency['p99']:7.2f}ms  {results[name]['rows_per_s'] or 0:10.0f} rows/s")
+
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "database": {"path": os.path.abspath(db_path), "notes": len(corpus.note_ids), "tags": len(corpus.tag_ids)},
+        "settings": {"iterations": iterations, "warmup": warmup, "seed": seed, "search_cache": search_cache, "startup_runs": startup_runs},
+        "peak_rss_kb": peak_rss_kb(),
+        "startup": startup,
+        "scenarios": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark DyNotes endpoints against a corpus database.")
+    parser.add_argument("db_path", help="Database made by benchmarks.corpus (update_mmr writes to it)")
+    parser.add_argument("--scenarios", nargs="+", choices=sorted(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--iterations", type=int, default=100)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--search_cache", action="store_true", help="Leave the /search result cache enabled")
+    parser.add_argument("--startup_runs", type=int, default=5, help="Fresh processes to time startup in (0 to skip)")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+
+    args = parser.parse_args()
+    # Keep request logging from dominating the measurements
+    logging.getLogger().setLevel(logging.WARNING)
+    dynotes.app.logger.setLevel(logging.WARNING)
+
+    report = run_benchmarks(args.db_path, args.scenarios, iterations=args.iterations, warmup=args.warmup, seed=args.seed, search_cache=args.search_cache, startup_runs=args.startup_runs)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}.")
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
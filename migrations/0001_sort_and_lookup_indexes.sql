@@ -0,0 +1,21 @@
+-- Composite indexes for `visibility <= ? ORDER BY <key>, note_id`.
+-- note_id is spelled out so the index order matches the keyset pagination
+-- order, and visibility rides along so the filter never touches the table.
+CREATE INDEX IF NOT EXISTS idx_notes_rating_sort ON Notes(rating, note_id, visibility);
+CREATE INDEX IF NOT EXISTS idx_notes_date_sort ON Notes(date, note_id, visibility);
+CREATE INDEX IF NOT EXISTS idx_notes_mmr_sort ON Notes(mmr, note_id, visibility);
+CREATE INDEX IF NOT EXISTS idx_notes_visibility_sort ON Notes(visibility);
+
+-- Covers the MMR sampler's candidate query (note_id is the rowid)
+CREATE INDEX IF NOT EXISTS idx_notes_visibility_mmr ON Notes(visibility, mmr, mmr_matches);
+
+-- Superseded by the sort indexes above and by idx_note_tags_tag_note
+DROP INDEX IF EXISTS idx_notes_date;
+DROP INDEX IF EXISTS idx_notes_mmr;
+DROP INDEX IF EXISTS idx_note_tags;
+
+-- delete_tag matches relationships by child as well as by parent
+CREATE INDEX IF NOT EXISTS idx_tag_relationships_child ON TagRelationships(child_tag_id, parent_tag_id);
+
+-- Tag password checks look up every password for one tag
+CREATE INDEX IF NOT EXISTS idx_tag_passwords_tag ON TagPasswords(tag_id, max_visibility);
@@ -0,0 +1,9 @@
+-- Comma-separated tag names per note, exactly what search used to build with
+-- GROUP_CONCAT for every result row. Kept current by refresh_tag_names().
+ALTER TABLE Notes ADD COLUMN tag_names TEXT;
+
+UPDATE Notes SET tag_names = (
+    SELECT GROUP_CONCAT(t.name)
+    FROM NoteTags nt JOIN Tags t ON t.tag_id = nt.tag_id
+    WHERE nt.note_id = Notes.note_id
+);
@@ -0,0 +1,3 @@
+-- Per-term document counts, used by the search planner to estimate how many
+-- notes a text query matches before deciding what drives the query.
+CREATE VIRTUAL TABLE IF NOT EXISTS NotesFTSVocab USING fts5vocab(NotesFTS, row);
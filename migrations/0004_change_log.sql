@@ -0,0 +1,16 @@
+-- Append-only feed behind /changes. Each entry holds the entity's whole new
+-- state, so compaction can drop any entry superseded by a newer one for the
+-- same entity; entries at or below change_log_floor are gone for good.
+CREATE TABLE IF NOT EXISTS ChangeLog (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at INTEGER NOT NULL,
+    entity TEXT NOT NULL, -- 'tag', 'relationship' or 'note'
+    entity_id TEXT NOT NULL, -- tag or note id, 'parent:child' for relationships
+    op TEXT NOT NULL, -- 'upsert' or 'delete'
+    visibility INTEGER, -- notes only; callers below it see a delete instead
+    data TEXT -- JSON state for upserts
+);
+
+CREATE INDEX IF NOT EXISTS idx_changelog_entity ON ChangeLog(entity, entity_id, seq);
+
+INSERT OR IGNORE INTO StatCounters (name, value) VALUES ('change_log_floor', 0);
@@ -0,0 +1,17 @@
+-- Bumped whenever a tag password is added or removed (including by
+-- delete_tag), in the same transaction. Access tokens carry the epoch they
+-- were issued under and cached visibility levels are dropped when it moves,
+-- so every worker process sees a revocation at once.
+INSERT OR IGNORE INTO StatCounters (name, value) VALUES ('auth_epoch', 0);
+
+CREATE TRIGGER IF NOT EXISTS auth_epoch_password_insert AFTER INSERT ON TagPasswords BEGIN
+    UPDATE StatCounters SET value = value + 1 WHERE name = 'auth_epoch';
+END;
+
+CREATE TRIGGER IF NOT EXISTS auth_epoch_password_update AFTER UPDATE ON TagPasswords BEGIN
+    UPDATE StatCounters SET value = value + 1 WHERE name = 'auth_epoch';
+END;
+
+CREATE TRIGGER IF NOT EXISTS auth_epoch_password_delete AFTER DELETE ON TagPasswords BEGIN
+    UPDATE StatCounters SET value = value + 1 WHERE name = 'auth_epoch';
+END;
@@ -0,0 +1,38 @@
+-- Bumped by every change to what the in-memory tag index holds: which notes
+-- carry which tags, note visibility, and the tag closure. Unlike
+-- data_version it ignores MMR votes, renames and the like, so other worker
+-- processes only rebuild their index when it is actually out of date.
+INSERT OR IGNORE INTO StatCounters (name, value) VALUES ('membership_version', 0);
+
+CREATE TRIGGER IF NOT EXISTS membership_note_tag_insert AFTER INSERT ON NoteTags BEGIN
+    UPDATE StatCounters SET value = value + 1 WHERE name = 'membership_version';
+END;
+
+CREATE TRIGGER IF NOT EXISTS membership_note_tag_delete AFTER DELETE ON NoteTags BEGIN
+    UPDATE StatCounters SET value = value + 1 WHERE name = 'membership_version';
+END;
+
+CREATE TRIGGER IF NOT EXISTS membership_note_insert AFTER INSERT ON Notes BEGIN
+    UPDATE StatCounters SET value = value + 1 WHERE name = 'membership_version';
+END;
+
+CREATE TRIGGER IF NOT EXISTS membership_note_delete AFTER DELETE ON Notes BEGIN
+    UPDATE StatCounters SET value = value + 1 WHERE name = 'membership_version';
+END;
+
+CREATE TRIGGER IF NOT EXISTS membership_note_visibility AFTER UPDATE OF visibility ON Notes
+WHEN old.visibility IS NOT new.visibility BEGIN
+    UPDATE StatCounters SET value = value + 1 WHERE name = 'membership_version';
+END;
+
+CREATE TRIGGER IF NOT EXISTS membership_closure_insert AFTER INSERT ON TagClosure BEGIN
+    UPDATE StatCounters SET value = value + 1 WHERE name = 'membership_version';
+END;
+
+CREATE TRIGGER IF NOT EXISTS membership_closure_update AFTER UPDATE ON TagClosure BEGIN
+    UPDATE StatCounters SET value = value + 1 WHERE name = 'membership_version';
+END;
+
+CREATE TRIGGER IF NOT EXISTS membership_closure_delete AFTER DELETE ON TagClosure BEGIN
+    UPDATE StatCounters SET value = value + 1 WHERE name = 'membership_version';
+END;
@@ -0,0 +1,47 @@
+-- StatVisibility.visibility was INTEGER PRIMARY KEY, a rowid alias: a note
+-- with NULL visibility got a fresh rowid as its "level", and its delete never
+-- found that row again. Levels are now a real key (WITHOUT ROWID, so never
+-- NULL) and notes without a visibility are counted in StatCounters instead.
+DROP TRIGGER IF EXISTS stats_note_insert;
+DROP TRIGGER IF EXISTS stats_note_delete;
+DROP TRIGGER IF EXISTS stats_note_update;
+
+CREATE TABLE StatVisibilityNew (
+    visibility INT PRIMARY KEY,
+    note_count INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+
+INSERT INTO StatVisibilityNew (visibility, note_count)
+SELECT visibility, COUNT(*) FROM Notes WHERE visibility IS NOT NULL GROUP BY visibility;
+
+DROP TABLE StatVisibility;
+ALTER TABLE StatVisibilityNew RENAME TO StatVisibility;
+
+INSERT OR REPLACE INTO StatCounters (name, value)
+VALUES ('null_visibility_count', (SELECT COUNT(*) FROM Notes WHERE visibility IS NULL));
+
+CREATE TRIGGER stats_note_insert AFTER INSERT ON Notes BEGIN
+    UPDATE StatCounters SET value = value + 1 WHERE name = 'note_count';
+    UPDATE StatCounters SET value = value + COALESCE(new.rating, 0) WHERE name = 'rating_sum';
+    UPDATE StatCounters SET value = value + (new.rating IS NOT NULL) WHERE name = 'rating_count';
+    UPDATE StatCounters SET value = value + (new.visibility IS NULL) WHERE name = 'null_visibility_count';
+    INSERT INTO StatVisibility (visibility, note_count) SELECT new.visibility, 1 WHERE new.visibility IS NOT NULL
+        ON CONFLICT (visibility) DO UPDATE SET note_count = note_count + 1;
+END;
+
+CREATE TRIGGER stats_note_delete AFTER DELETE ON Notes BEGIN
+    UPDATE StatCounters SET value = value - 1 WHERE name = 'note_count';
+    UPDATE StatCounters SET value = value - COALESCE(old.rating, 0) WHERE name = 'rating_sum';
+    UPDATE StatCounters SET value = value - (old.rating IS NOT NULL) WHERE name = 'rating_count';
+    UPDATE StatCounters SET value = value - (old.visibility IS NULL) WHERE name = 'null_visibility_count';
+    UPDATE StatVisibility SET note_count = note_count - 1 WHERE visibility = old.visibility;
+END;
+
+CREATE TRIGGER stats_note_update AFTER UPDATE OF rating, visibility ON Notes BEGIN
+    UPDATE StatCounters SET value = value - COALESCE(old.rating, 0) + COALESCE(new.rating, 0) WHERE name = 'rating_sum';
+    UPDATE StatCounters SET value = value - (old.rating IS NOT NULL) + (new.rating IS NOT NULL) WHERE name = 'rating_count';
+    UPDATE StatCounters SET value = value - (old.visibility IS NULL) + (new.visibility IS NULL) WHERE name = 'null_visibility_count';
+    UPDATE StatVisibility SET note_count = note_count - 1 WHERE visibility = old.visibility;
+    INSERT INTO StatVisibility (visibility, note_count) SELECT new.visibility, 1 WHERE new.visibility IS NOT NULL
+        ON CONFLICT (visibility) DO UPDATE SET note_count = note_count + 1;
+END;
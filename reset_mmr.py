@@ -1,5 +1,8 @@
 import sqlite3
 import argparse
+import time
+
+from app import NOTE_CHANGE_DATA, compact_change_log
 
 """
 
@@ -8,14 +11,47 @@ python reset_mmr.py
 
 python reset_mmr.py notes.db --base_mmr 1600 --star_increment 150
 
+# recompute ratings from the Comparisons log
+python reset_mmr.py notes.db --replay elo --k_factors 40 24 16
+python reset_mmr.py notes.db --replay bt
+
+Both modes bump data_version and log every note to the ChangeLog in the same
+transaction, so a running server drops its cached orderings and ETags and
+/changes clients see the new ratings.
+
 """
 
+# Same tiers as calculate_k_factor in app.py: (matches below, K)
+DEFAULT_K_FACTORS = (32, 24, 16)
+K_FACTOR_THRESHOLDS = (10, 20)
+
+
+def connect(db_path):
+    # Autocommit mode, so BEGIN IMMEDIATE below is the only transaction
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    return conn, conn.cursor()
+
+
+def publish_mmr_changes(cursor):
+    """Do what a write through the app would: bump data_version and log each note's new state."""
+    cursor.execute("UPDATE StatCounters SET value = value + 1 WHERE name = 'data_version'")
+    if cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'ChangeLog'").fetchone() is None:
+        return
+    cursor.execute(
+        f"""
+    INSERT INTO ChangeLog (created_at, entity, entity_id, op, visibility, data)
+    SELECT ?, 'note', note_id, 'upsert', visibility, {NOTE_CHANGE_DATA}
+    FROM Notes""",
+        (int(time.time()),),
+    )
+    compact_change_log(cursor)
+
 
 def reset_mmr(db_path="notes.db", base_mmr=1500, star_increment=100):
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    conn, cursor = connect(db_path)
 
     try:
+        cursor.execute("BEGIN IMMEDIATE")
         # Reset MMR and match count for all notes
         cursor.execute(
             """
@@ -33,9 +69,134 @@ def reset_mmr(db_path="notes.db", base_mmr=1500, star_increment=100):
         """,
             [base_mmr - 2 * star_increment, base_mmr - star_increment, base_mmr, base_mmr + star_increment, base_mmr + 2 * star_increment, base_mmr],
         )
+        affected = cursor.rowcount
+
+        publish_mmr_changes(cursor)
+        conn.commit()
+        print(f"MMR reset complete. Affected {affected} notes.")
+    except sqlite3.Error as e:
+        print(f"An error occurred: {e}")
+        conn.rollback()
+    finally:
+        conn.close()
+
+
+def star_mmr(rating, base_mmr, star_increment):
+    if rating in (1, 2, 3, 4, 5):
+        return base_mmr + (rating - 3) * star_increment
+    return base_mmr
+
+
+def load_comparisons(cursor):
+    """Return the note ids (sorted) and winner/loser index arrays in vote order."""
+    import numpy as np
+
+    cursor.execute("SELECT note_id, rating FROM Notes ORDER BY note_id")
+    notes = cursor.fetchall()
+    note_ids = np.fromiter((row[0] for row in notes), dtype=np.int64, count=len(notes))
+    ratings = np.fromiter((row[1] if row[1] is not None else 3 for row in notes), dtype=np.int64, count=len(notes))
+
+    cursor.execute("SELECT winner_id, loser_id FROM Comparisons ORDER BY comparison_id")
+    pairs = np.array(cursor.fetchall(), dtype=np.int64).reshape(-1, 2)
+    if not len(note_ids):
+        pairs = pairs[:0]
+
+    # Votes involving deleted notes can't be written back, so drop them
+    winners = np.searchsorted(note_ids, pairs[:, 0])
+    losers = np.searchsorted(note_ids, pairs[:, 1])
+    winners = np.minimum(winners, len(note_ids) - 1)
+    losers = np.minimum(losers, len(note_ids) - 1)
+    valid = (note_ids[winners] == pairs[:, 0]) & (note_ids[losers] == pairs[:, 1])
+    return note_ids, ratings, winners[valid], losers[valid]
+
+
+def replay_elo(note_ids, ratings, winners, losers, base_mmr, star_increment, k_factors):
+    """Re-run the live Elo rules over the log, starting from star-based ratings.
+
+    Every note starts where reset_mmr would put it, base_mmr plus
+    star_increment per star above three. That matches the live ratings only
+    if the votes began right after such a reset: notes made through /add_note
+    start at a flat 1500 (use --star_increment 0 and the default --base_mmr
+    for that), and votes cast before the Comparisons table existed are not
+    in the log at all. Elo is order-dependent, so this walks the votes sequentially over plain
+    lists, which is faster than indexing NumPy arrays one element at a time.
+    """
+    mmr = [star_mmr(int(rating), base_mmr, star_increment) for rating in ratings]
+    matches = [0] * len(note_ids)
+    new_k, settling_k, settled_k = k_factors
+    first_threshold, second_threshold = K_FACTOR_THRESHOLDS
+
+    def k_factor(count):
+        return new_k if count < first_threshold else settling_k if count < second_threshold else settled_k
+
+    for w, l in zip(winners.tolist(), losers.tolist()):
+        winner_k = k_factor(matches[w])
+        loser_k = k_factor(matches[l])
+        expected_winner = 1 / (1 + 10 ** ((mmr[l] - mmr[w]) / 400))
+        winner_change = max(1, int(winner_k * (1 - expected_winner)))
+        loser_change = min(-1, int(loser_k * (0 - (1 - expected_winner))))
+        mmr[w] += winner_change
+        mmr[l] += loser_change
+        matches[w] += 1
+        matches[l] += 1
+
+    return mmr, matches
+
+
+def replay_bradley_terry(note_ids, winners, losers, base_mmr, iterations=500, tolerance=1e-9):
+    """Fit Bradley-Terry strengths to the whole log with vectorized MM updates.
+
+    Each note also gets one virtual win and loss against an average opponent,
+    which keeps undefeated and winless notes finite. Strengths are mapped to
+    the Elo scale around base_mmr.
+    """
+    import numpy as np
+
+    n = len(note_ids)
+    wins = np.bincount(winners, minlength=n) + 1.0
+    games = np.bincount(winners, minlength=n) + np.bincount(losers, minlength=n)
+    strength = np.ones(n)
+
+    for _ in range(iterations):
+        inverse_sum = 1.0 / (strength[winners] + strength[losers])
+        denominator = np.bincount(winners, weights=inverse_sum, minlength=n) + np.bincount(losers, weights=inverse_sum, minlength=n)
+        # Two virtual games against a strength-1 opponent
+        denominator += 2.0 / (strength + 1.0)
+        updated = wins / denominator
+        updated /= np.exp(np.mean(np.log(updated)))
+        if np.max(np.abs(updated - strength)) < tolerance:
+            strength = updated
+            break
+        strength = updated
+
+    mmr = np.rint(base_mmr + 400 * np.log10(strength)).astype(np.int64)
+    return mmr.tolist(), games.tolist()
+
+
+def replay_mmr(db_path="notes.db", method="elo", base_mmr=1500, star_increment=100, k_factors=DEFAULT_K_FACTORS):
+    try:
+        import numpy  # noqa: F401
+    except ImportError:
+        print("Replaying comparisons requires numpy: pip install numpy")
+        return
+
+    conn, cursor = connect(db_path)
+
+    try:
+        started = time.perf_counter()
+        # Taken before reading the log, so no vote can land between the read and the write
+        cursor.execute("BEGIN IMMEDIATE")
+        note_ids, ratings, winners, losers = load_comparisons(cursor)
+
+        if method == "bt":
+            mmr, matches = replay_bradley_terry(note_ids, winners, losers, base_mmr)
+        else:
+            mmr, matches = replay_elo(note_ids, ratings, winners, losers, base_mmr, star_increment, k_factors)
 
+        cursor.executemany("UPDATE Notes SET mmr = ?, mmr_matches = ? WHERE note_id = ?", zip(mmr, matches, note_ids.tolist()))
+        publish_mmr_changes(cursor)
         conn.commit()
-        print(f"MMR reset complete. Affected {cursor.rowcount} notes.")
+        print(f"Replayed {len(winners)} comparisons over {len(note_ids)} notes ({method}) in {time.perf_counter() - started:.2f}s.")
     except sqlite3.Error as e:
         print(f"An error occurred: {e}")
         conn.rollback()
@@ -48,7 +209,12 @@ if __name__ == "__main__":
     parser.add_argument("db_path", help="Path to the SQLite database file")
     parser.add_argument("--base_mmr", type=int, default=1500, help="Base MMR for 3-star notes (default: 1500)")
     parser.add_argument("--star_increment", type=int, default=100, help="MMR increment per star (default: 100)")
+    parser.add_argument("--replay", choices=["elo", "bt"], help="Recompute ratings from the Comparisons log with Elo or a Bradley-Terry fit")
+    parser.add_argument("--k_factors", type=int, nargs=3, default=DEFAULT_K_FACTORS, help="Elo K for <10, <20 and 20+ matches (default: 32 24 16)")
 
     args = parser.parse_args()
 
-    reset_mmr(args.db_path, args.base_mmr, args.star_increment)
+    if args.replay:
+        replay_mmr(args.db_path, args.replay, args.base_mmr, args.star_increment, tuple(args.k_factors))
+    else:
+        reset_mmr(args.db_path, args.base_mmr, args.star_increment)
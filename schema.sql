@@ -1,3 +1,6 @@
+-- Baseline schema. Changes to existing databases go in migrations/, applied by init_db in
+-- PRAGMA user_version order on top of this file.
+
 -- Create the Tags table
 CREATE TABLE IF NOT EXISTS Tags (
     tag_id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -51,4 +54,128 @@ CREATE TABLE IF NOT EXISTS TagPasswords (
     password_hash TEXT NOT NULL,
     max_visibility INTEGER NOT NULL,
     FOREIGN KEY (tag_id) REFERENCES Tags(tag_id)
-);
\ No newline at end of file
+);
+
+-- Full-text index over note bodies, kept in sync with Notes by triggers
+CREATE VIRTUAL TABLE IF NOT EXISTS NotesFTS USING fts5(
+    text,
+    author,
+    source,
+    content='Notes',
+    content_rowid='note_id',
+    tokenize='unicode61 remove_diacritics 2'
+);
+
+CREATE TRIGGER IF NOT EXISTS notes_fts_insert AFTER INSERT ON Notes BEGIN
+    INSERT INTO NotesFTS(rowid, text, author, source) VALUES (new.note_id, new.text, new.author, new.source);
+END;
+
+CREATE TRIGGER IF NOT EXISTS notes_fts_delete AFTER DELETE ON Notes BEGIN
+    INSERT INTO NotesFTS(NotesFTS, rowid, text, author, source) VALUES ('delete', old.note_id, old.text, old.author, old.source);
+END;
+
+CREATE TRIGGER IF NOT EXISTS notes_fts_update AFTER UPDATE OF text, author, source ON Notes BEGIN
+    INSERT INTO NotesFTS(NotesFTS, rowid, text, author, source) VALUES ('delete', old.note_id, old.text, old.author, old.source);
+    INSERT INTO NotesFTS(rowid, text, author, source) VALUES (new.note_id, new.text, new.author, new.source);
+END;
+
+
+-- Transitive closure of TagRelationships: one row per (ancestor, descendant)
+-- pair including each tag with itself at depth 0. depth is the shortest path.
+CREATE TABLE IF NOT EXISTS TagClosure (
+    ancestor_id INTEGER NOT NULL,
+    descendant_id INTEGER NOT NULL,
+    depth INTEGER NOT NULL,
+    PRIMARY KEY (ancestor_id, descendant_id)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_tag_closure_descendant ON TagClosure(descendant_id, ancestor_id);
+
+-- Lets the closure join reach note ids without touching the NoteTags rows
+CREATE INDEX IF NOT EXISTS idx_note_tags_tag_note ON NoteTags(tag_id, note_id);
+
+
+-- Every MMR vote, in order, so ratings can be recomputed from scratch.
+-- No foreign keys: history is kept even after a note is deleted.
+CREATE TABLE IF NOT EXISTS Comparisons (
+    comparison_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    winner_id INTEGER NOT NULL,
+    loser_id INTEGER NOT NULL,
+    date INTEGER NOT NULL -- Unix timestamp
+);
+
+
+-- Running totals behind /get_stats, maintained by the triggers below
+CREATE TABLE IF NOT EXISTS StatCounters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL DEFAULT 0
+);
+
+INSERT OR IGNORE INTO StatCounters (name, value) VALUES
+    ('note_count', 0),
+    ('tag_count', 0),
+    ('relationship_count', 0),
+    ('rating_sum', 0),
+    ('rating_count', 0),
+    ('data_version', 0); -- bumped by every committed write, used for ETags
+
+CREATE TABLE IF NOT EXISTS StatVisibility (
+    visibility INTEGER PRIMARY KEY,
+    note_count INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS TagUsage (
+    tag_id INTEGER PRIMARY KEY,
+    usage_count INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS idx_tag_usage_count ON TagUsage(usage_count);
+
+CREATE TRIGGER IF NOT EXISTS stats_note_insert AFTER INSERT ON Notes BEGIN
+    UPDATE StatCounters SET value = value + 1 WHERE name = 'note_count';
+    UPDATE StatCounters SET value = value + COALESCE(new.rating, 0) WHERE name = 'rating_sum';
+    UPDATE StatCounters SET value = value + (new.rating IS NOT NULL) WHERE name = 'rating_count';
+    INSERT INTO StatVisibility (visibility, note_count) VALUES (new.visibility, 1)
+        ON CONFLICT (visibility) DO UPDATE SET note_count = note_count + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS stats_note_delete AFTER DELETE ON Notes BEGIN
+    UPDATE StatCounters SET value = value - 1 WHERE name = 'note_count';
+    UPDATE StatCounters SET value = value - COALESCE(old.rating, 0) WHERE name = 'rating_sum';
+    UPDATE StatCounters SET value = value - (old.rating IS NOT NULL) WHERE name = 'rating_count';
+    UPDATE StatVisibility SET note_count = note_count - 1 WHERE visibility IS old.visibility;
+END;
+
+CREATE TRIGGER IF NOT EXISTS stats_note_update AFTER UPDATE OF rating, visibility ON Notes BEGIN
+    UPDATE StatCounters SET value = value - COALESCE(old.rating, 0) + COALESCE(new.rating, 0) WHERE name = 'rating_sum';
+    UPDATE StatCounters SET value = value - (old.rating IS NOT NULL) + (new.rating IS NOT NULL) WHERE name = 'rating_count';
+    UPDATE StatVisibility SET note_count = note_count - 1 WHERE visibility IS old.visibility;
+    INSERT INTO StatVisibility (visibility, note_count) VALUES (new.visibility, 1)
+        ON CONFLICT (visibility) DO UPDATE SET note_count = note_count + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS stats_tag_insert AFTER INSERT ON Tags BEGIN
+    UPDATE StatCounters SET value = value + 1 WHERE name = 'tag_count';
+END;
+
+CREATE TRIGGER IF NOT EXISTS stats_tag_delete AFTER DELETE ON Tags BEGIN
+    UPDATE StatCounters SET value = value - 1 WHERE name = 'tag_count';
+    DELETE FROM TagUsage WHERE tag_id = old.tag_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS stats_relationship_insert AFTER INSERT ON TagRelationships BEGIN
+    UPDATE StatCounters SET value = value + 1 WHERE name = 'relationship_count';
+END;
+
+CREATE TRIGGER IF NOT EXISTS stats_relationship_delete AFTER DELETE ON TagRelationships BEGIN
+    UPDATE StatCounters SET value = value - 1 WHERE name = 'relationship_count';
+END;
+
+CREATE TRIGGER IF NOT EXISTS stats_note_tag_insert AFTER INSERT ON NoteTags BEGIN
+    INSERT INTO TagUsage (tag_id, usage_count) VALUES (new.tag_id, 1)
+        ON CONFLICT (tag_id) DO UPDATE SET usage_count = usage_count + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS stats_note_tag_delete AFTER DELETE ON NoteTags BEGIN
+    UPDATE TagUsage SET usage_count = usage_count - 1 WHERE tag_id = old.tag_id;
+END;
@@ -203,17 +203,15 @@ class TagGraph {
     }
 
     async loadData(): Promise<void> {
-        const [tagsResponse, relationshipsResponse] = await Promise.all([
-            fetch(fetchpath + '/tags'),
-            fetch(fetchpath + '/tag_relationships')
-        ]);
-        const tags: Tag[] = await tagsResponse.json();
-        const relationships: { parent_tag_id: number, child_tag_id: number }[] = await relationshipsResponse.json();
-
-        this.nodes = tags.map(tag => ({ ...tag, children: [], visible: !relationships.some(r => r.child_tag_id === tag.tag_id) }));
-        this.links = relationships.map(rel => ({
-            source: this.nodes.find(n => n.tag_id === rel.parent_tag_id)!,
-            target: this.nodes.find(n => n.tag_id === rel.child_tag_id)!
+        const response = await fetch(fetchpath + '/graph');
+        const graph: { tags: Tag[], edges: [number, number][] } = await response.json();
+        const childIds = new Set(graph.edges.map(([, childId]) => childId));
+
+        this.nodes = graph.tags.map(tag => ({ ...tag, children: [], visible: !childIds.has(tag.tag_id) }));
+        const nodesById = new Map(this.nodes.map(node => [node.tag_id, node]));
+        this.links = graph.edges.map(([parentId, childId]) => ({
+            source: nodesById.get(parentId)!,
+            target: nodesById.get(childId)!
         }));
 
         this.nodes.forEach(node => {
@@ -1907,6 +1905,7 @@ let areRatingsVisible = false;
 let isComparisonInProgress = false;
 
 class MMRComparison {
+    private static readonly BATCH_SIZE = 8;
     private toast: HTMLElement;
     private notes: NodeListOf<HTMLElement>;
     private toastTimeout: number | null = null;
@@ -1998,14 +1997,14 @@ class MMRComparison {
         const password = (document.getElementById("searchPassword") as HTMLInputElement).value;
 
         try {
-            const response = await fetch(fetchpath + '/get_mmr_notes', {
+            const response = await fetch(fetchpath + '/get_mmr_batch', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ tags, password })
+                body: JSON.stringify({ tags, password, count: MMRComparison.BATCH_SIZE })
             });
-            const notes = await response.json();
-            if (notes.length === 2) {
-                this.comparisonQueue.push(notes);
+            const pairs: SearchResult[][] = await response.json();
+            if (pairs.length > 0) {
+                this.comparisonQueue.push(...pairs);
             } else {
                 console.warn('Not enough notes found for comparison.');
             }
@@ -160,16 +160,14 @@ class TagGraph {
         }
     }
     async loadData() {
-        const [tagsResponse, relationshipsResponse] = await Promise.all([
-            fetch(fetchpath + '/tags'),
-            fetch(fetchpath + '/tag_relationships')
-        ]);
-        const tags = await tagsResponse.json();
-        const relationships = await relationshipsResponse.json();
-        this.nodes = tags.map(tag => ({ ...tag, children: [], visible: !relationships.some(r => r.child_tag_id === tag.tag_id) }));
-        this.links = relationships.map(rel => ({
-            source: this.nodes.find(n => n.tag_id === rel.parent_tag_id),
-            target: this.nodes.find(n => n.tag_id === rel.child_tag_id)
+        const response = await fetch(fetchpath + '/graph');
+        const graph = await response.json();
+        const childIds = new Set(graph.edges.map(([, childId]) => childId));
+        this.nodes = graph.tags.map(tag => ({ ...tag, children: [], visible: !childIds.has(tag.tag_id) }));
+        const nodesById = new Map(this.nodes.map(node => [node.tag_id, node]));
+        this.links = graph.edges.map(([parentId, childId]) => ({
+            source: nodesById.get(parentId),
+            target: nodesById.get(childId)
         }));
         this.nodes.forEach(node => {
             node.children = this.links.filter(link => link.source === node).map(link => link.target);
@@ -1621,6 +1619,7 @@ let currentMMRNotes = [];
 let areRatingsVisible = false;
 let isComparisonInProgress = false;
 class MMRComparison {
+    static BATCH_SIZE = 8;
     toast;
     notes;
     toastTimeout = null;
@@ -1702,14 +1701,14 @@ class MMRComparison {
         const tags = Array.from(window.tagGraph.selectedNodes).map((n) => n.tag_id);
         const password = document.getElementById("searchPassword").value;
         try {
-            const response = await fetch(fetchpath + '/get_mmr_notes', {
+            const response = await fetch(fetchpath + '/get_mmr_batch', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ tags, password })
+                body: JSON.stringify({ tags, password, count: MMRComparison.BATCH_SIZE })
             });
-            const notes = await response.json();
-            if (notes.length === 2) {
-                this.comparisonQueue.push(notes);
+            const pairs = await response.json();
+            if (pairs.length > 0) {
+                this.comparisonQueue.push(...pairs);
             }
             else {
                 console.warn('Not enough notes found for comparison.');
@@ -0,0 +1,72 @@
+import os
+import sqlite3
+import sys
+from collections import OrderedDict
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as dynotes  # noqa: E402
+
+
+class Api:
+    """Thin wrapper over the test client for the write endpoints the tests lean on."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def post(self, path, body):
+        response = self.client.post(path, json=body)
+        assert response.status_code == 200, (path, body, response.get_json())
+        return response.get_json()
+
+    def add_tag(self, name):
+        return self.post("/add_tag", {"name": name, "readable_id": name})["tag_id"]
+
+    def link(self, parent_id, child_id):
+        self.post("/update_tag_relationships", {"parent_id": parent_id, "child_id": child_id})
+
+    def unlink(self, parent_id, child_id):
+        self.post("/remove_tag_relationship", {"parent_id": parent_id, "child_id": child_id})
+
+    def add_note(self, text, tags=(), visibility=1, rating=3):
+        body = {"author": "test", "rating": rating, "source": "test", "visibility": visibility, "text": text, "tags": list(tags)}
+        return self.post("/add_note", body)["note_id"]
+
+
+@pytest.fixture
+def app_state(tmp_path, monkeypatch):
+    """Point the app at a new database path (not yet created) with its caches reset."""
+    path = str(tmp_path / "notes.db")
+    monkeypatch.setattr(dynotes, "DATABASE", path)
+    # Module-level caches are keyed by versions that restart with every database
+    monkeypatch.setattr(dynotes, "tag_index", dynotes.TagIndex())
+    monkeypatch.setattr(dynotes, "search_cache", dynotes.SearchCache())
+    monkeypatch.setattr(dynotes, "mmr_sampler", dynotes.MMRSampler())
+    monkeypatch.setattr(dynotes, "visibility_cache", dynotes.VisibilityCache())
+    monkeypatch.setattr(dynotes, "_versioned_bodies", OrderedDict())
+    yield path
+    dynotes.get_write_queue().drain()
+    dynotes.close_pools()
+
+
+@pytest.fixture
+def database(app_state):
+    """A fresh, fully migrated database."""
+    dynotes.init_db()
+    return app_state
+
+
+@pytest.fixture
+def api(database):
+    return Api(dynotes.app.test_client())
+
+
+@pytest.fixture
+def raw_db(database):
+    """A plain connection, standing in for another worker process or a CLI script."""
+    conn = sqlite3.connect(database, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    yield conn
+    conn.close()
@@ -0,0 +1,73 @@
+import os
+import sqlite3
+
+import pytest
+
+import app as dynotes
+
+BASELINE_SCHEMA = os.path.join(os.path.dirname(__file__), "fixtures", "baseline_schema.sql")
+
+
+def create_baseline_database(path):
+    """A database as the app left it before any migrations, with a little of everything in it."""
+    conn = sqlite3.connect(path)
+    with open(BASELINE_SCHEMA) as f:
+        conn.executescript(f.read())
+    conn.executemany("INSERT INTO Tags (tag_id, name, readable_id) VALUES (?, ?, ?)", [(1, "Root", "root"), (2, "Kid", "kid"), (3, "Grandkid", "grandkid")])
+    conn.executemany("INSERT INTO TagRelationships (parent_tag_id, child_tag_id) VALUES (?, ?)", [(1, 2), (2, 3)])
+    notes = [
+        (1, "ann", 1700000000, 5, "web", 1, "apples and pears", 1540, 3),
+        (2, "bob", 1700000100, 2, "book", 3, "pears only", 1460, 3),
+        (3, "cid", 1700000200, None, "talk", 5, "no fruit here", 1500, 0),
+        (4, "dee", 1700000300, 4, "web", None, "hidden apples", 1500, 0),
+    ]
+    conn.executemany("INSERT INTO Notes (note_id, author, date, rating, source, visibility, text, mmr, mmr_matches) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", notes)
+    conn.executemany("INSERT INTO NoteTags (note_id, tag_id) VALUES (?, ?)", [(1, 3), (2, 2), (3, 1), (4, 3)])
+    conn.execute("INSERT INTO TagPasswords (tag_id, password_hash, max_visibility) VALUES (2, 'unused', 3)")
+    conn.commit()
+    conn.close()
+
+
+def search_ids(client, **body):
+    response = client.post("/search", json={"tags": [], "text": "", "password": "pw5", **body})
+    assert response.status_code == 200, response.get_json()
+    return sorted(note["note_id"] for note in response.get_json())
+
+
+@pytest.mark.parametrize("upgraded_to", [0, 3, 6])
+def test_baseline_database_upgrades_through_every_migration(app_state, monkeypatch, upgraded_to):
+    create_baseline_database(app_state)
+    migrations = dynotes.load_migrations()
+    if upgraded_to:
+        # Stop part-way first, as a database last opened by an older release would be
+        with monkeypatch.context() as patch:
+            patch.setattr(dynotes, "load_migrations", lambda: migrations[:upgraded_to])
+            dynotes.init_db()
+
+    dynotes.init_db()
+
+    conn = sqlite3.connect(app_state)
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(migrations)
+    assert conn.execute("PRAGMA integrity_check").fetchone()[0] == "ok"
+    assert dynotes.apply_migrations(conn) == []
+    assert sorted(conn.execute("SELECT ancestor_id, descendant_id, depth FROM TagClosure")) == [(1, 1, 0), (1, 2, 1), (1, 3, 2), (2, 2, 0), (2, 3, 1), (3, 3, 0)]
+    assert dict(conn.execute("SELECT note_id, tag_names FROM Notes")) == {1: "Grandkid", 2: "Kid", 3: "Root", 4: "Grandkid"}
+    conn.close()
+
+    with dynotes.app.app_context():
+        db = dynotes.get_db()
+        assert dynotes.rebuild_stats(db.cursor()) == {}
+        db.rollback()
+
+    client = dynotes.app.test_client()
+    stats = client.get("/get_stats").get_json()
+    assert (stats["note_count"], stats["tag_count"], stats["relationship_count"]) == (4, 3, 2)
+    assert stats["visibility_counts"] == {"1": 1, "3": 1, "5": 1, "null": 1}
+    assert search_ids(client, text="apples") == [1]
+    assert search_ids(client, tags=[1]) == [1, 2, 3]
+    assert search_ids(client, tags=[2], text="pears") == [1, 2]
+
+    # The upgraded database takes writes like a new one
+    response = client.post("/add_note", json={"author": "eve", "rating": 3, "source": "web", "visibility": 2, "text": "more apples", "tags": [3]})
+    assert response.status_code == 200
+    assert search_ids(client, tags=[1], text="apples") == [1, response.get_json()["note_id"]]
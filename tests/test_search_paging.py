@@ -0,0 +1,71 @@
+import pytest
+
+SORTS = ["stars", "date", "visibility", "mmr"]
+PAGE_SIZE = 6
+
+
+@pytest.fixture
+def paging_notes(api, raw_db):
+    """40 notes under one tag with plenty of ties and some NULL ratings; half mention apples."""
+    tag_id = api.add_tag("t")
+    for i in range(40):
+        rating = None if i % 7 == 0 else 1 + i % 3
+        api.add_note(f"note {i}" + (" apple" if i % 2 else ""), tags=[tag_id], visibility=1 + i % 5, rating=rating)
+    raw_db.executescript(
+        """
+        BEGIN;
+        UPDATE Notes SET mmr = 1500 + (note_id % 4) * 25, date = 1700000000 + note_id % 3;
+        UPDATE StatCounters SET value = value + 1 WHERE name = 'data_version';
+        COMMIT;
+    """
+    )
+    return tag_id
+
+
+def offset_pages(conn, tag_id, sort_field, direction, text):
+    column = {"stars": "rating", "date": "date", "visibility": "visibility", "mmr": "mmr"}[sort_field]
+    query = f"""
+    SELECT note_id FROM Notes
+    WHERE visibility <= 5 AND note_id IN (SELECT note_id FROM NoteTags WHERE tag_id = ?)
+    {"AND note_id IN (SELECT rowid FROM NotesFTS WHERE NotesFTS MATCH ?)" if text else ""}
+    ORDER BY {column} {direction}, note_id {direction}
+    LIMIT ? OFFSET ?"""
+    pages, offset = [], 0
+    while True:
+        params = [tag_id] + ([text] if text else []) + [PAGE_SIZE, offset]
+        page = [row[0] for row in conn.execute(query, params)]
+        if not page:
+            return pages
+        pages.append(page)
+        offset += PAGE_SIZE
+
+
+def keyset_pages(api, tag_id, sort_criteria, text):
+    pages, cursor = [], None
+    while True:
+        body = {"tags": [tag_id], "text": text, "password": "pw5", "sortCriteria": sort_criteria, "limit": PAGE_SIZE}
+        if cursor:
+            body["cursor"] = cursor
+        response = api.post("/search", body)
+        pages.append([note["note_id"] for note in response["results"]])
+        cursor = response["next_cursor"]
+        if cursor is None:
+            return pages
+
+
+@pytest.mark.parametrize("text", ["", "apple"])
+@pytest.mark.parametrize("direction", ["asc", "desc"])
+@pytest.mark.parametrize("sort_field", SORTS)
+def test_keyset_paging_matches_offset_paging(api, raw_db, paging_notes, sort_field, direction, text):
+    sort_criteria = f"{sort_field}-{direction}"
+    expected = offset_pages(raw_db, paging_notes, sort_field, direction.upper(), text)
+    assert keyset_pages(api, paging_notes, sort_criteria, text) == expected
+
+    unpaged = api.post("/search", {"tags": [paging_notes], "text": text, "password": "pw5", "sortCriteria": sort_criteria})
+    assert [note["note_id"] for note in unpaged] == [note_id for page in expected for note_id in page]
+
+
+@pytest.mark.parametrize("body", [{"limit": 0}, {"limit": "5"}, {"limit": 5, "cursor": "not a cursor"}])
+def test_bad_limits_and_cursors_are_rejected(api, body):
+    response = api.client.post("/search", json={"tags": [], "text": "", "sortCriteria": "stars-desc", **body})
+    assert response.status_code == 400
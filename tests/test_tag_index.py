@@ -0,0 +1,93 @@
+from itertools import combinations
+
+import app as dynotes
+
+# Notes visible at the level that carry a descendant (or the tag itself) of
+# every selected tag, walking TagRelationships directly rather than trusting
+# TagClosure; with nothing selected, every visible tagged note
+REFERENCE_SQL = """
+WITH RECURSIVE under(ancestor_id, tag_id) AS (
+    SELECT tag_id, tag_id FROM Tags
+    UNION
+    SELECT u.ancestor_id, r.child_tag_id FROM under u JOIN TagRelationships r ON r.parent_tag_id = u.tag_id
+)
+SELECT n.note_id FROM Notes n
+WHERE n.visibility <= ? AND EXISTS (SELECT 1 FROM NoteTags WHERE note_id = n.note_id)
+"""
+REFERENCE_TAG_CONDITION = """
+AND EXISTS (SELECT 1 FROM NoteTags nt JOIN under u ON u.tag_id = nt.tag_id WHERE nt.note_id = n.note_id AND u.ancestor_id = ?)"""
+
+
+def reference_ids(conn, selected_tags, visibility_level):
+    query = REFERENCE_SQL + REFERENCE_TAG_CONDITION * len(selected_tags)
+    return {row[0] for row in conn.execute(query, [visibility_level, *selected_tags])}
+
+
+def assert_index_matches_sql(api, conn):
+    tag_ids = [row[0] for row in conn.execute("SELECT tag_id FROM Tags")]
+    selections = [()] + [(tag_id,) for tag_id in tag_ids] + list(combinations(tag_ids, 2))
+    for level in range(1, 6):
+        for selected in selections:
+            expected = reference_ids(conn, selected, level)
+            with dynotes.app.app_context():
+                index = dynotes.tag_index.sync(dynotes.get_read_db())
+                assert set(dynotes.bitmap_ids(index.matching(selected, level))) == expected, (selected, level)
+            if selected:
+                results = api.post("/search", {"tags": list(selected), "text": "", "password": f"pw{level}"})
+                assert {note["note_id"] for note in results} == expected, (selected, level)
+
+
+def test_tag_index_follows_edits(api, raw_db):
+    a, b, c, d = (api.add_tag(name) for name in "abcd")
+    api.link(a, b)
+    api.link(b, c)
+    notes = [api.add_note(f"note {i}", tags=tags, visibility=1 + i % 5) for i, tags in enumerate([[a], [b], [c], [d], [b, d], [c, d], [a, c], [d]])]
+    assert_index_matches_sql(api, raw_db)
+
+    api.link(a, d)
+    assert_index_matches_sql(api, raw_db)
+
+    api.unlink(a, b)
+    assert_index_matches_sql(api, raw_db)
+
+    api.post("/edit_note", {"noteId": notes[1], "tags": [c, d], "visibility": 5})
+    api.post("/edit_note", {"noteId": notes[3], "visibility": 1})
+    assert_index_matches_sql(api, raw_db)
+
+    api.post("/delete_note", {"noteId": notes[4]})
+    api.add_note("late", tags=[b], visibility=2)
+    assert_index_matches_sql(api, raw_db)
+
+    api.post("/delete_tag", {"tag_id": c})
+    assert_index_matches_sql(api, raw_db)
+
+
+def test_tag_index_rebuilds_after_foreign_membership_change(api, raw_db):
+    a, b = api.add_tag("a"), api.add_tag("b")
+    note_id = api.add_note("note", tags=[a])
+    assert_index_matches_sql(api, raw_db)
+    rebuilds = dynotes.tag_index.rebuilds
+
+    # Writes as another worker's writer commits them, data_version bump included.
+    # An MMR vote doesn't touch membership, so the index stays as it is
+    raw_db.executescript(
+        f"""
+        BEGIN;
+        UPDATE Notes SET mmr = mmr + 10 WHERE note_id = {note_id};
+        UPDATE StatCounters SET value = value + 1 WHERE name = 'data_version';
+        COMMIT;
+    """
+    )
+    assert_index_matches_sql(api, raw_db)
+    assert dynotes.tag_index.rebuilds == rebuilds
+
+    raw_db.executescript(
+        f"""
+        BEGIN;
+        INSERT INTO NoteTags (note_id, tag_id) VALUES ({note_id}, {b});
+        UPDATE StatCounters SET value = value + 1 WHERE name = 'data_version';
+        COMMIT;
+    """
+    )
+    assert_index_matches_sql(api, raw_db)
+    assert dynotes.tag_index.rebuilds == rebuilds + 1
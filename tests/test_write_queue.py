@@ -0,0 +1,98 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import app as dynotes
+
+
+def test_concurrent_votes_lose_no_updates(api, raw_db):
+    note_ids = [api.add_note(f"note {i}") for i in range(4)]
+    rng = random.Random(7)
+    pairs = [tuple(rng.sample(note_ids, 2)) for _ in range(120)]
+
+    def vote(pair):
+        client = dynotes.app.test_client()
+        return client.post("/update_mmr", json={"winner_id": pair[0], "loser_id": pair[1]}).status_code
+
+    with ThreadPoolExecutor(max_workers=12) as pool:
+        assert set(pool.map(vote, pairs)) == {200}
+
+    ratings = {row["note_id"]: (row["mmr"], row["mmr_matches"]) for row in raw_db.execute("SELECT note_id, mmr, mmr_matches FROM Notes")}
+    assert sum(matches for _, matches in ratings.values()) == 2 * len(pairs)
+
+    # Every vote read the ratings the previous one left, so replaying the
+    # log in commit order lands on exactly the stored ratings
+    replayed = {note_id: [1500, 0] for note_id in note_ids}
+    comparisons = raw_db.execute("SELECT winner_id, loser_id FROM Comparisons ORDER BY comparison_id").fetchall()
+    assert len(comparisons) == len(pairs)
+    for winner_id, loser_id in comparisons:
+        winner, loser = replayed[winner_id], replayed[loser_id]
+        winner_change, loser_change = dynotes.calculate_mmr_changes(winner[0], winner[1], loser[0], loser[1])
+        winner[0] += winner_change
+        loser[0] += loser_change
+        winner[1] += 1
+        loser[1] += 1
+    assert {note_id: tuple(rating) for note_id, rating in replayed.items()} == ratings
+
+
+def _insert_note(cursor, text):
+    cursor.execute("INSERT INTO Notes (author, date, source, text) VALUES ('test', 0, 'test', ?)", (text,))
+    return cursor.lastrowid
+
+
+def _insert_note_then_fail(cursor, text):
+    _insert_note(cursor, text)
+    raise ValueError("job failed")
+
+
+def test_failing_job_rolls_back_alone(database, raw_db):
+    write_queue = dynotes.WriteQueue(database)
+    started = threading.Event()
+    release = threading.Event()
+
+    def hold_writer(cursor):
+        started.set()
+        release.wait(10)
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        blocker = pool.submit(write_queue.submit, hold_writer)
+        assert started.wait(10)
+        # Queued behind the blocker, so the writer takes all three as one group
+        first = pool.submit(write_queue.submit, _insert_note, "first")
+        failing = pool.submit(write_queue.submit, _insert_note_then_fail, "failing")
+        last = pool.submit(write_queue.submit, _insert_note, "last")
+        deadline = time.monotonic() + 10
+        while write_queue.stats()["depth"] < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        release.set()
+
+        blocker.result(10)
+        assert isinstance(first.result(10), int)
+        assert isinstance(last.result(10), int)
+        with pytest.raises(ValueError):
+            failing.result(10)
+
+    texts = {row["text"] for row in raw_db.execute("SELECT text FROM Notes")}
+    assert texts == {"first", "last"}
+    stats = write_queue.stats()
+    assert stats["commits"] == 2
+    assert (stats["completed"], stats["failed"]) == (3, 1)
+
+
+# The killed writer thread's exception is the point of the test
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnhandledThreadExceptionWarning")
+def test_dead_writer_is_restarted(database, raw_db):
+    write_queue = dynotes.WriteQueue(database)
+
+    def kill_writer(cursor):
+        raise SystemExit
+
+    with pytest.raises(SystemExit):
+        write_queue.submit(kill_writer)
+    note_id = write_queue.submit(_insert_note, "after restart")
+
+    assert raw_db.execute("SELECT text FROM Notes WHERE note_id = ?", (note_id,)).fetchone()["text"] == "after restart"
+    assert write_queue.stats()["restarts"] == 1